@@ -0,0 +1,280 @@
+import argparse
+import gc
+import glob
+import json
+import math
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+# Benchmark of reading and shaping with the bundled fonts. Each font is
+# shaped on a fixed corpus: the input lines of the traces in trace_dir
+# whose glyphs are all in the font, plus sequences of its own. Results go
+# to a JSON file, and can be compared to those of an earlier run, the
+# baseline, failing if the font got slower or bigger beyond a threshold.
+# Times are of loops of reading or shaping long enough to clear the noise
+# of the timer, divided by the loops. The baseline is made of several runs
+# (python benchmark.py --runs 3 --output benchmark_baseline.json).
+
+from ttxread import read_ttx
+from ttxfont import TRACE_OFF
+
+trace_dir = 'traces'
+gen_dir = 'generated'
+
+# The TTX of the eot font, made from eot.ttf by ttx (fonttools) if needed,
+# where the other scripts read it; it is not committed (cf. .gitignore)
+def eot_ttx():
+	if not os.path.isfile('eot.ttx'):
+		proc = subprocess.Popen(['ttx', '-q', 'eot.ttf'])
+		proc.wait()
+	return 'eot.ttx'
+
+def trace_lines():
+	lines = []
+	for filename in sorted(glob.glob(os.path.join(trace_dir, '*.txt'))):
+		with open(filename) as file:
+			tokens = file.readline().split()
+		if len(tokens) > 0:
+			lines.append(tokens)
+	return lines
+
+def string_tokens(font, s):
+	cmap = font.charset_total if len(font.charset_total) > 0 else font.charset_large
+	return [cmap[ord(c)] for c in s if ord(c) in cmap]
+
+# Groups of signs joined by controls, as in the traces, drawn with a fixed seed
+def eot_sequences(font, n=30):
+	rnd = random.Random(1234)
+	signs = sorted(name for name in font.charset_total.values() if re.fullmatch(r'[A-Z][a-z]?\d+[a-z]?', name))
+	controls = ['vj', 'hj', 'ts', 'bs', 'te', 'be']
+	sequences = []
+	for i in range(n):
+		length = rnd.randint(1, 9)
+		sequence = []
+		for j in range(length):
+			sequence.append(rnd.choice(signs[:300]))
+			if j < length - 1:
+				sequence.append(rnd.choice(controls[:2]) if rnd.random() < 0.7 else rnd.choice(controls))
+		sequences.append(sequence)
+	return sequences
+
+def andromeda_sequences(font):
+	texts = ['The quick brown fox jumps over the lazy dog.', 'office affinity 1/2 3/4 No. 1st 2nd',
+		'SPHINX OF BLACK QUARTZ, JUDGE MY VOW!', 'fi fl ffi ffl waffle shuffle']
+	return [string_tokens(font, text) for text in texts]
+
+def addition_sequences(font):
+	texts = ['1+1=', '12+34=', '999+1=', '123456+654321=', '31415926+27182818=']
+	return [string_tokens(font, text) for text in texts]
+
+def capital_sequences(font):
+	rnd = random.Random(1234)
+	return [[rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for j in range(rnd.randint(1, 12))] for i in range(20)]
+
+# Name, TTX file, suppressed features and own sequences of each font
+def benchmark_fonts():
+	fonts = [('eot', eot_ttx, ['ss01', 'rtlm'], eot_sequences),
+		('andromeda', lambda: os.path.join('andromeda', 'AndromedaSL.ttx'), [], andromeda_sequences),
+		('addition', lambda: os.path.join('addition', 'AdditionFont.ttx'), [], addition_sequences)]
+	for filename in sorted(glob.glob(os.path.join(gen_dir, 'test*.ttx'))):
+		if '#' not in filename:
+			name = os.path.splitext(os.path.basename(filename))[0]
+			fonts.append((name, lambda filename=filename: filename, [], capital_sequences))
+	return fonts
+
+def shape_corpus(font, corpus, suppressed):
+	for tokens in corpus:
+		font.apply(tokens, suppressed=suppressed, trace=TRACE_OFF)
+
+# How many times in a row f is to be called for the calls to take at least
+# min_time, as found from a first call.
+def calibrate(f, min_time):
+	start = time.perf_counter()
+	f()
+	first = time.perf_counter() - start
+	return max(1, math.ceil(min_time / first)) if first > 0 else 1
+
+# The time of calling f loops times in a row, divided by loops.
+def loop_time(f, loops):
+	start = time.perf_counter()
+	for i in range(loops):
+		f()
+	return (time.perf_counter() - start) / loops
+
+# The peak memory of shaping the corpus, samples times, each after a
+# collection, so that garbage of what ran before does not count.
+def peak_memories(font, corpus, suppressed, samples):
+	peaks = []
+	for i in range(samples):
+		gc.collect()
+		tracemalloc.start()
+		shape_corpus(font, corpus, suppressed)
+		peaks.append(tracemalloc.get_traced_memory()[1])
+		tracemalloc.stop()
+	return peaks
+
+# The fonts are read and their corpora shaped once each to find the loops
+# (cf. calibrate), the first shaping also compiling lookups not compiled
+# on reading. The timed repeats then go round the fonts, so that each font
+# is timed at moments spread over the run, and a slow spell of the machine
+# shows in the spread of its times (cf. compare) rather than in its median.
+def run(names=None, repeats=5, load_repeats=3, min_time=0.1, memory_samples=3):
+	benches = []
+	for name, filename, suppressed, sequences in benchmark_fonts():
+		if names is None or name in names:
+			filename = filename()
+			load = lambda filename=filename: read_ttx(filename)
+			load_loops = calibrate(load, min_time)
+			font = read_ttx(filename)
+			glyphs = set(font.glyphs)
+			corpus = [tokens for tokens in trace_lines() if set(tokens) <= glyphs] + sequences(font)
+			shape = lambda font=font, corpus=corpus, suppressed=suppressed: \
+				shape_corpus(font, corpus, suppressed)
+			benches.append({'name': name, 'file': filename, 'font': font, 'corpus': corpus, \
+				'suppressed': suppressed, 'load': load, 'load_loops': load_loops, 'load_times': [], \
+				'shape': shape, 'loops': calibrate(shape, min_time), 'times': []})
+	for i in range(max(repeats, load_repeats)):
+		for bench in benches:
+			if i < load_repeats:
+				bench['load_times'].append(loop_time(bench['load'], bench['load_loops']))
+			if i < repeats:
+				bench['times'].append(loop_time(bench['shape'], bench['loops']))
+	results = []
+	for bench in benches:
+		peaks = peak_memories(bench['font'], bench['corpus'], bench['suppressed'], memory_samples)
+		results.append(summarize({'font': bench['name'], 'file': bench['file'],
+			'load_loops': bench['load_loops'], 'load_times': bench['load_times'],
+			'sequences': len(bench['corpus']), 'glyphs': sum(len(tokens) for tokens in bench['corpus']),
+			'loops': bench['loops'], 'times': bench['times'], 'peak_memories': peaks}))
+	return {'date': datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0],
+		'platform': platform.platform(), 'repeats': repeats, 'min_time': min_time, 'runs': 1,
+		'results': results}
+
+# The medians of the measurements of a result, added to it.
+def summarize(result):
+	median = statistics.median(result['times'])
+	result['load_time'] = statistics.median(result['load_times'])
+	result['median_time'] = median
+	result['glyphs_per_second'] = result['glyphs'] / median if median > 0 else None
+	result['peak_memory'] = statistics.median(result['peak_memories'])
+	return result
+
+# Runs one after another as one run with the measurements of all, so that
+# their spread shows how much the machine varies from run to run, and not
+# only within one; a baseline is best made so (cf. compare).
+def merge_runs(runs):
+	merged = runs[0]
+	for other in runs[1:]:
+		for result, other_result in zip(merged['results'], other['results']):
+			for key in ['load_times', 'times', 'peak_memories']:
+				result[key] = result[key] + other_result[key]
+			for key in ['load_loops', 'loops']:
+				result[key] = min(result[key], other_result[key])
+	for result in merged['results']:
+		summarize(result)
+	merged['runs'] = len(runs)
+	return merged
+
+def results_str(run_results):
+	s = '{:18} {:>8} {:>6} {:>7} {:>10} {:>12} {:>10}\n'.format( \
+		'font', 'load s', 'seqs', 'glyphs', 'median s', 'glyphs/s', 'peak KiB')
+	for r in run_results['results']:
+		s += '{:18} {:>8.3f} {:>6} {:>7} {:>10.4f} {:>12.0f} {:>10.0f}\n'.format( \
+			r['font'], r['load_time'], r['sequences'], r['glyphs'], r['median_time'], \
+			r['glyphs_per_second'] or 0, r['peak_memory'] / 1024)
+	return s
+
+def interquartile_range(values):
+	if len(values) < 2:
+		return 0.0
+	quartiles = statistics.quantiles(values, n=4)
+	return quartiles[2] - quartiles[0]
+
+# The metrics compared with the baseline: name, the repeated measurements
+# of a result, and for times, the loops each was divided by (cf.
+# calibrate), or None for memory. Results of earlier runs may lack some.
+metrics = [('shaping time', lambda r: r['times'], lambda r: r.get('loops', 1)),
+	('load time', lambda r: r.get('load_times', [r['load_time']]), lambda r: r.get('load_loops', 1)),
+	('peak memory', lambda r: r.get('peak_memories', [r['peak_memory']]), None)]
+
+# For each font in both runs and each metric, the baseline and current
+# medians and the relative change. A metric regresses if its median grew
+# by more than threshold, and by more than the interquartile range of
+# either run, so that noise of the repeated runs is not taken for a
+# regression; and a time by more than min_seconds over its loops, the
+# noise of the timer, and a peak by more than min_bytes. Shaping time
+# stands for throughput, as the corpus is fixed.
+def compare(baseline, current, threshold, min_seconds=0.005, min_bytes=8192):
+	rows = []
+	baseline_results = {r['font']: r for r in baseline['results']}
+	for r in current['results']:
+		b = baseline_results.get(r['font'])
+		if b is None:
+			continue
+		for metric, values, loops in metrics:
+			old = values(b)
+			new = values(r)
+			old_median = statistics.median(old)
+			new_median = statistics.median(new)
+			change = (new_median - old_median) / old_median if old_median > 0 else 0.0
+			noise = max(interquartile_range(old), interquartile_range(new))
+			if loops is not None:
+				noise = max(noise, min_seconds / min(loops(b), loops(r)))
+			else:
+				noise = max(noise, min_bytes)
+			regressed = change > threshold and new_median - old_median > noise
+			rows.append({'font': r['font'], 'metric': metric, 'baseline': old_median,
+				'current': new_median, 'change': change, 'noise': noise, 'regressed': regressed})
+	return rows
+
+def comparison_str(rows):
+	s = '{:18} {:14} {:>14} {:>14} {:>8} {:>12}\n'.format( \
+		'font', 'metric', 'baseline', 'current', 'change', '')
+	for row in rows:
+		s += '{:18} {:14} {:>14.6g} {:>14.6g} {:>+7.1f}% {:>12}\n'.format( \
+			row['font'], row['metric'], row['baseline'], row['current'], 100 * row['change'], \
+			'REGRESSION' if row['regressed'] else '')
+	return s
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark reading and shaping with the bundled fonts.')
+	parser.add_argument('fonts', nargs='*', help='fonts to run (default all): eot, andromeda, addition, test1, ...')
+	parser.add_argument('--repeats', type=int, default=5, help='timed passes over each corpus')
+	parser.add_argument('--load-repeats', type=int, default=3, help='timed readings of each font')
+	parser.add_argument('--min-time', type=float, default=0.1, \
+		help='seconds each timed pass or reading is looped for at least')
+	parser.add_argument('--memory-samples', type=int, default=3, help='measurements of peak memory')
+	parser.add_argument('--runs', type=int, default=1, \
+		help='whole runs merged into the results, as for a baseline')
+	parser.add_argument('--output', default='benchmark.json', help='JSON file for the results')
+	parser.add_argument('--baseline', help='JSON file of earlier results to compare with')
+	parser.add_argument('--threshold', type=float, default=0.1, \
+		help='relative growth of a median that counts as a regression')
+	parser.add_argument('--min-seconds', type=float, default=0.005, \
+		help='growth of a looped time below which it is not a regression')
+	parser.add_argument('--min-bytes', type=int, default=8192, \
+		help='growth of a median peak memory below which it is not a regression')
+	args = parser.parse_args()
+	run_results = merge_runs([run(args.fonts if len(args.fonts) > 0 else None, args.repeats, \
+		args.load_repeats, args.min_time, args.memory_samples) for i in range(args.runs)])
+	with open(args.output, 'w') as file:
+		json.dump(run_results, file, indent=1)
+	print(results_str(run_results), end='')
+	if args.baseline is not None:
+		with open(args.baseline) as file:
+			baseline = json.load(file)
+		rows = compare(baseline, run_results, args.threshold, args.min_seconds, args.min_bytes)
+		print()
+		print(comparison_str(rows), end='')
+		regressions = [row for row in rows if row['regressed']]
+		if len(regressions) > 0:
+			print(f'{len(regressions)} regression(s) beyond {100 * args.threshold:.0f}%')
+			sys.exit(1)
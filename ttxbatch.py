@@ -0,0 +1,41 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Shaping of many token sequences at once, spread over worker processes.
+# Each worker gets the font once, when it starts; the tasks only carry the
+# sequences. Where processes are forked the font is not even pickled.
+
+worker_font = None
+
+def init_worker(font):
+	global worker_font
+	worker_font = font
+
+# The result of shaping one sequence, given as a list of glyph names or a
+# string, or the exception raised.
+def shape_one(font, sequence, suppressed, trace, render):
+	try:
+		if isinstance(sequence, str):
+			sequence = font.string_to_tokens(sequence)
+		if render:
+			return font.render(list(sequence), suppressed=suppressed, trace=trace)
+		return font.apply(list(sequence), suppressed=suppressed, trace=trace)
+	except Exception as e:
+		return e
+
+def shape_in_worker(args):
+	sequence, suppressed, trace, render = args
+	return shape_one(worker_font, sequence, suppressed, trace, render)
+
+# Results in the order of the sequences. With at most one worker, the
+# sequences are shaped in this process.
+def shape_many(font, sequences, suppressed, trace, render, workers, chunksize, mp_context):
+	if workers is not None and workers <= 1:
+		return [shape_one(font, sequence, suppressed, trace, render) for sequence in sequences]
+	if mp_context is None and 'fork' in multiprocessing.get_all_start_methods():
+		mp_context = multiprocessing.get_context('fork')
+	font.compile()
+	tasks = ((sequence, suppressed, trace, render) for sequence in sequences)
+	with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, \
+			initializer=init_worker, initargs=(font,)) as executor:
+		return list(executor.map(shape_in_worker, tasks, chunksize=chunksize))
@@ -0,0 +1,223 @@
+from array import array
+
+import numpy as np
+
+# Glyph buffer that lookups edit in place, after HarfBuzz. During a GSUB pass
+# the glyphs before the cursor are in out and the glyphs from the cursor on
+# are info[idx:]; a glyph passed over or substituted moves to out, and swap()
+# makes out the input of the next pass. Positions are positions in the whole
+# sequence, out followed by info[idx:], as seen by the rules.
+# Each glyph also has a cluster, the index of the first input glyph it comes
+# from, kept in info_clusters and out_clusters alongside. A substitution
+# merges the clusters of the glyphs it replaces, so the clusters never
+# decrease along the sequence.
+class GlyphBuffer:
+	def __init__(self, glyphs, history=None):
+		self.info = array('H', glyphs)
+		self.info_clusters = array('I', range(len(self.info)))
+		self.idx = 0
+		self.out = array('H')
+		self.out_clusters = array('I')
+		# Incremented on every edit of the sequence
+		self.version = 0
+		self.copy = None
+		self.copy_version = -1
+		# Filtered views by mask, kept up to date with the edits
+		self.views = {}
+		# Where the edits are recorded, if anywhere
+		self.history = history
+		# The glyphs that are or have been in the buffer
+		self.present = set(self.info)
+
+	def __len__(self):
+		return len(self.out) + len(self.info) - self.idx
+
+	def __getitem__(self, pos):
+		n_out = len(self.out)
+		if pos < n_out:
+			return self.out[pos]
+		return self.info[self.idx + pos - n_out]
+
+	def position(self):
+		return len(self.out)
+
+	def clear_output(self):
+		self.out = array('H')
+		self.out_clusters = array('I')
+		self.idx = 0
+		self.views = {}
+
+	def swap(self):
+		self.out.extend(self.info[self.idx:])
+		self.out_clusters.extend(self.info_clusters[self.idx:])
+		self.info = self.out
+		self.info_clusters = self.out_clusters
+		self.out = array('H')
+		self.out_clusters = array('I')
+		self.idx = 0
+
+	def next_glyph(self):
+		self.out.append(self.info[self.idx])
+		self.out_clusters.append(self.info_clusters[self.idx])
+		self.idx += 1
+
+	# Pass over the glyphs up to the next one in glyphs. Returns False if
+	# there is none.
+	def skip_to(self, glyphs):
+		info = self.info
+		idx = self.idx
+		while idx < len(info) and info[idx] not in glyphs:
+			idx += 1
+		self.out.extend(info[self.idx:idx])
+		self.out_clusters.extend(self.info_clusters[self.idx:idx])
+		self.idx = idx
+		return idx < len(info)
+
+	# Move the cursor to a position, moving glyphs between out and info.
+	def move_to(self, pos):
+		n_out = len(self.out)
+		if pos > n_out:
+			count = pos - n_out
+			self.out.extend(self.info[self.idx:self.idx+count])
+			self.out_clusters.extend(self.info_clusters[self.idx:self.idx+count])
+			self.idx += count
+		elif pos < n_out:
+			count = n_out - pos
+			glyphs = self.out[pos:]
+			clusters = self.out_clusters[pos:]
+			del self.out[pos:]
+			del self.out_clusters[pos:]
+			if self.idx >= count:
+				self.idx -= count
+				self.info[self.idx:self.idx+count] = glyphs
+				self.info_clusters[self.idx:self.idx+count] = clusters
+			else:
+				self.info[:self.idx] = glyphs
+				self.info_clusters[:self.idx] = clusters
+				self.idx = 0
+
+	# Replace the n_in glyphs at the cursor by outputs, which the cursor
+	# passes over, followed by pending glyphs, which are still to be visited.
+	def replace(self, n_in, outputs, pending=[]):
+		pos = len(self.out)
+		if self.history is not None:
+			inserted = array('H', outputs)
+			inserted.extend(pending)
+			self.history.edits.append((pos, self.info[self.idx:self.idx+n_in], inserted))
+		cluster = self.info_clusters[self.idx]
+		self.idx += n_in
+		self.out.extend(outputs)
+		self.out_clusters.extend(array('I', [cluster]) * len(outputs))
+		self.present.update(outputs)
+		if len(pending) > 0:
+			self.idx -= len(pending)
+			self.info[self.idx:self.idx+len(pending)] = array('H', pending)
+			self.info_clusters[self.idx:self.idx+len(pending)] = array('I', [cluster]) * len(pending)
+		self.version += 1
+		for view in self.views.values():
+			view.kept[pos:pos+n_in] = bytearray(map(view.mask.__getitem__, outputs)) + \
+				bytearray(map(view.mask.__getitem__, pending))
+
+	# Replace the whole sequence, as a pass of substitutions would, by glyphs
+	# and clusters, arrays like info and info_clusters. No edit is logged.
+	def replace_all(self, glyphs, clusters):
+		self.info = glyphs
+		self.info_clusters = clusters
+		self.idx = 0
+		self.out = array('H')
+		self.out_clusters = array('I')
+		self.version += 1
+		self.views = {}
+
+	# Copy of the whole sequence, shared until the next edit.
+	def snapshot(self):
+		if self.copy_version != self.version:
+			self.copy = self.out + self.info[self.idx:]
+			self.copy_version = self.version
+		return self.copy
+
+	def clusters(self):
+		return self.out_clusters + self.info_clusters[self.idx:]
+
+	def view(self, mask):
+		view = self.views.get(id(mask))
+		if view is None:
+			view = FilteredView(self, mask)
+			self.views[id(mask)] = view
+		return view
+
+# The glyphs of a buffer that a lookup does not skip, as a mask over the
+# positions, with navigation to the nearest unskipped glyph on either side.
+class FilteredView:
+	def __init__(self, tokens, mask):
+		self.tokens = tokens
+		self.mask = mask
+		self.kept = bytearray(map(mask.__getitem__, tokens.snapshot()))
+
+	def next(self, pos):
+		return self.kept.find(1, pos+1)
+
+	def prev(self, pos):
+		return self.kept.rfind(1, 0, pos)
+
+# Positionings of the glyphs of a buffer, as arrays of offsets mutated in
+# place by the GPOS lookups: the placement (XCoordinate, YCoordinate) and
+# the advance adjustment (XAdvance) of each glyph. Which of these have been
+# set is kept as well, so that the positioning of a glyph can be seen as a
+# dict of those set only, as it used to be; indexing and iterating give
+# such dicts.
+class PositionBuffer:
+	keys = ('XCoordinate', 'YCoordinate', 'XAdvance')
+
+	def __init__(self, n):
+		self.values = np.zeros((len(self.keys), n), dtype=np.int32)
+		self.given = np.zeros((len(self.keys), n), dtype=np.bool_)
+
+	def __len__(self):
+		return self.values.shape[1]
+
+	def __getitem__(self, pos):
+		if isinstance(pos, slice):
+			return [self[p] for p in range(*pos.indices(len(self)))]
+		if pos < 0:
+			pos += len(self)
+		return {key: int(self.values[k, pos]) for k, key in enumerate(self.keys) if self.given[k, pos]}
+
+	def __iter__(self):
+		return iter(self.to_list())
+
+	def __eq__(self, other):
+		return self.to_list() == list(other)
+
+	def __add__(self, other):
+		return self.to_list() + list(other)
+
+	def __radd__(self, other):
+		return list(other) + self.to_list()
+
+	def to_list(self):
+		return [self[pos] for pos in range(len(self))]
+
+	def __repr__(self):
+		return repr(self.to_list())
+
+	def set_value(self, pos, key, value):
+		k = self.keys.index(key)
+		self.values[k, pos] = value
+		self.given[k, pos] = True
+
+	# Sets key of the glyphs at positions, an array, to values
+	def scatter(self, key, positions, values):
+		k = self.keys.index(key)
+		self.values[k, positions] = values
+		self.given[k, positions] = True
+
+	# The offsets of all glyphs, 0 where not set
+	def x(self):
+		return self.values[0]
+
+	def y(self):
+		return self.values[1]
+
+	def x_advance(self):
+		return self.values[2]
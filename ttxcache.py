@@ -0,0 +1,44 @@
+from collections import OrderedDict
+
+# Bounded cache of rendering results. With eviction 'lru' the entry used
+# least recently is dropped when the cache is full, with 'fifo' the entry
+# added first.
+class RenderCache:
+	def __init__(self, size=256, eviction='lru'):
+		if eviction not in ('lru', 'fifo'):
+			raise ValueError('Unknown eviction: ' + str(eviction))
+		self.size = size
+		self.eviction = eviction
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key):
+		result = self.entries.get(key)
+		if result is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+			if self.eviction == 'lru':
+				self.entries.move_to_end(key)
+		return result
+
+	def put(self, key, result):
+		if self.size <= 0:
+			return
+		self.entries[key] = result
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def clear(self):
+		self.entries.clear()
+
+	def __str__(self):
+		return 'entries: {}/{}, hits: {}, misses: {}, evictions: {}'.format( \
+			len(self.entries), self.size, self.hits, self.misses, self.evictions)
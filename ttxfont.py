@@ -1,61 +1,74 @@
 import os
+from array import array
+import numpy as np
+from bisect import bisect_left
+from itertools import islice
 from lxml import etree
 from datetime import datetime
 
 from ttxtables import read_basic_properties, read_post
-
-def equiv(elem1, elem2):
-	if isinstance(elem1, list):
-		return elem2 in elem1
-	elif isinstance(elem2, list):
-		return elem1 in elem2
-	else:
-		return elem1 == elem2
-
-def equiv_list(l1, l2):
-	return all([equiv(pair[0], pair[1]) for pair in zip(l1, l2)])
-
-def is_suffix_of(l1, l2):
-	return len(l1) <= len(l2) and equiv_list(l1, l2[-len(l1):])
-	
-def is_prefix_of(l1, l2):
-	return len(l1) <= len(l2) and equiv_list(l1, l2[:len(l1)])
-
-def filter_glyph(glyph, font, lookup):
+from ttxbuffer import GlyphBuffer, PositionBuffer
+from ttxtrace import TRACE_OFF, TRACE_COUNTS, TRACE_FULL, Application, History, copy_applications
+from ttxcache import RenderCache
+from ttxbatch import shape_many
+from ttxwindow import Stages, safe_end, stream_crossings, reshape
+
+# The name of the glyph that stands for input names the font does not know.
+# It is not a valid glyph name, so no font has a glyph with it.
+UNKNOWN_GLYPH = '<unknown>'
+
+# The lookup flags and mark filtering set that determine which glyphs a
+# lookup skips. Lookups with the same key share one filter mask.
+def filter_key(lookup):
+	return (lookup.ignore_base_glyphs, lookup.ignore_ligatures, lookup.ignore_marks, \
+		lookup.mark_class, lookup.filter_set)
+
+def unfiltered(glyph, font, key, filter_glyphs):
+	ignore_base_glyphs, ignore_ligatures, ignore_marks, mark_class, filter_set = key
 	# Check if glyph exists in classification system
 	if glyph not in font.glyph_to_class:
 		return True  # Allow unclassified glyphs by default
 	
-	if lookup.ignore_base_glyphs and font.glyph_to_class[glyph] == BASE_GLYPH:
+	if ignore_base_glyphs and font.glyph_to_class[glyph] == BASE_GLYPH:
 		return False
-	if lookup.ignore_ligatures and font.glyph_to_class[glyph] == LIGATURE_GLYPH:
+	if ignore_ligatures and font.glyph_to_class[glyph] == LIGATURE_GLYPH:
 		return False
-	if lookup.ignore_marks and font.glyph_to_class[glyph] == MARK_GLYPH:
+	if ignore_marks and font.glyph_to_class[glyph] == MARK_GLYPH:
 		return False
-	if lookup.mark_class != 0 and \
+	if mark_class != 0 and \
 			(glyph not in font.mark_to_class or \
-				font.mark_to_class[glyph] != lookup.mark_class):
+				font.mark_to_class[glyph] != mark_class):
 		return False
-	if lookup.filter_set is not None and \
-			lookup.filter_set in font.index_to_glyphs and \
-			glyph not in font.index_to_glyphs[lookup.filter_set]:
+	if filter_glyphs is not None and glyph not in filter_glyphs:
 		return False
 	return True
 
-def filter_list(l, filter):
-	return [token for token in l if filter(token)]
-
-def first_filtered_left(l, filter):
-	for i in range(len(l)):
-		if filter(l[i]):
-			return i
-	return -1
-
-def first_filtered_right(l, filter):
-	for i in reversed(range(len(l))):
-		if filter(l[i]):
-			return i
-	return -1
+# The view is kept by the buffer and shared by the lookups with the same mask.
+def filtered_view(tokens, font, lookup):
+	return tokens.view(lookup.mask)
+
+# The glyph IDs a context element stands for: a glyph name or a coverage.
+def glyph_id_set(elem, font):
+	if isinstance(elem, str):
+		return frozenset([font.glyph_id(elem)])
+	return frozenset(font.glyph_id(glyph) for glyph in elem)
+
+# Match sets of glyph IDs against the unskipped glyphs after pos, resp. before
+# pos (the last set nearest to pos), walking no further than needed.
+# Returns the position of the last glyph matched, or None.
+def match_right(id_sets, view, pos):
+	for id_set in id_sets:
+		pos = view.next(pos)
+		if pos < 0 or view.tokens[pos] not in id_set:
+			return None
+	return pos
+
+def match_left(id_sets, view, pos):
+	for id_set in reversed(id_sets):
+		pos = view.prev(pos)
+		if pos < 0 or view.tokens[pos] not in id_set:
+			return None
+	return pos
 
 # Type 1
 class SingleSubstitution1:
@@ -66,16 +79,22 @@ class SingleSubstitution1:
 	def length(self):
 		return 1
 
+	def first_glyphs(self):
+		return [self.input]
+
+	def compile(self, font):
+		self.input_id = font.glyph_id(self.input)
+		self.output_id = font.glyph_id(self.output)
+
 	def recur(self, tokens, pos, font, lookup):
 		return None
 
 	def applicable(self, tokens, pos, font, lookup):
-		return pos < len(tokens) and tokens[pos] == self.input
+		return pos < len(tokens) and tokens[pos] == self.input_id
 
 	def apply(self, tokens, pos, font, lookup):
-		tokens = tokens.copy()
-		tokens[pos] = self.output
-		return tokens, 1, [pos]
+		tokens.replace(1, [self.output_id])
+		return [pos]
 
 	def __str__(self):
 		return self.input + ' -> ' + self.output
@@ -89,18 +108,22 @@ class MultSubstitution:
 	def length(self):
 		return 1
 
+	def first_glyphs(self):
+		return [self.input]
+
+	def compile(self, font):
+		self.input_id = font.glyph_id(self.input)
+		self.output_ids = [font.glyph_id(output) for output in self.outputs]
+
 	def recur(self, tokens, pos, font, lookup):
 		return None
 
 	def applicable(self, tokens, pos, font, lookup):
-		return pos < len(tokens) and tokens[pos] == self.input
+		return pos < len(tokens) and tokens[pos] == self.input_id
 
 	def apply(self, tokens, pos, font, lookup):
-		tokens = tokens.copy()
-		del tokens[pos]
-		for token in reversed(self.outputs):
-			tokens.insert(pos, token)
-		return tokens, len(self.outputs), [pos]
+		tokens.replace(1, self.output_ids)
+		return [pos]
 
 	def __str__(self):
 		return self.input + ' -> ' + ' '.join(self.outputs)
@@ -114,30 +137,67 @@ class LigSubstitution:
 	def length(self):
 		return len(self.inputs)
 
+	def first_glyphs(self):
+		return [self.inputs[0]]
+
+	def compile(self, font):
+		self.first_id = font.glyph_id(self.inputs[0])
+		self.component_sets = [glyph_id_set(input, font) for input in self.inputs[1:]]
+		self.output_id = font.glyph_id(self.output)
+
 	def recur(self, tokens, pos, font, lookup):
 		return None
 
 	def applicable(self, tokens, pos, font, lookup):
-		return pos < len(tokens) and tokens[pos] == self.inputs[0] and \
-			is_prefix_of(self.inputs[1:], \
-				filter_list(tokens[pos+1:], lambda t : filter_glyph(t, font, lookup)))
+		return pos < len(tokens) and tokens[pos] == self.first_id and \
+			match_right(self.component_sets, filtered_view(tokens, font, lookup), pos) is not None
 
 	def apply(self, tokens, pos, font, lookup):
-		tokens = tokens.copy()
+		view = filtered_view(tokens, font, lookup)
 		posses = [pos]
-		i = pos+1
 		while len(posses) < len(self.inputs):
-			if filter_glyph(tokens[i], font, lookup):
-				posses.append(i)
-			i += 1
-		for i in reversed(posses):
-			del tokens[i]
-		tokens.insert(pos, self.output)
-		return tokens, 1, posses
+			posses.append(view.next(posses[-1]))
+		# Skipped glyphs between the components come after the ligature
+		skipped = [tokens[i] for i in range(pos+1, posses[-1]) if not view.kept[i]]
+		tokens.replace(posses[-1] - pos + 1, [self.output_id], skipped)
+		return posses
 
 	def __str__(self):
 		return ' '.join(self.inputs) + ' -> ' + self.output
 
+# Trie of the components of the ligatures of a lookup. The children are
+# indexed by glyph ID; terminal is the rule whose components lead from the
+# root to the node, the first in the order in which rules are attempted if
+# there are several.
+class LigatureTrie:
+	def __init__(self):
+		self.children = {}
+		self.terminal = None
+
+	def add(self, substitution):
+		nodes = [self.children.setdefault(substitution.first_id, LigatureTrie())]
+		for id_set in substitution.component_sets:
+			nodes = [node.children.setdefault(id, LigatureTrie()) for node in nodes for id in id_set]
+		for node in nodes:
+			if node.terminal is None:
+				node.terminal = substitution
+
+	# The rule of the longest ligature starting at pos, found by walking the
+	# unskipped glyphs from pos down the trie.
+	def longest_match(self, tokens, pos, view):
+		match = None
+		node = self.children.get(tokens[pos])
+		while node is not None:
+			if node.terminal is not None:
+				match = node.terminal
+			if len(node.children) == 0:
+				break
+			pos = view.next(pos)
+			if pos < 0:
+				break
+			node = node.children.get(tokens[pos])
+		return match
+
 # Type 6, Format 3
 class ChainSubstitution3:
 	def __init__(self, lefts, inputs, rights, refs):
@@ -149,39 +209,42 @@ class ChainSubstitution3:
 	def length(self):
 		return len(self.lefts) + len(self.inputs) + len(self.rights)
 
+	def first_glyphs(self):
+		first = self.inputs[0]
+		return [first] if isinstance(first, str) else first
+
+	def compile(self, font):
+		self.left_sets = [glyph_id_set(left, font) for left in self.lefts]
+		self.input_sets = [glyph_id_set(input, font) for input in self.inputs]
+		self.right_sets = [glyph_id_set(right, font) for right in self.rights]
+
 	def recur(self, tokens, pos, font, lookup):
 		posses = self.filtered_input_positions(tokens, pos, font, lookup)
 		return [(posses[p], index) for (p, index) in self.refs]
 
 	def applicable(self, tokens, pos, font, lookup):
-		if False:
-			if len(tokens) > 2 and tokens[1] == 'ch0' and lookup.index == 99 and pos == 1:
-				print(self.left)
-				print(self.input + self.right)
-				print(filter_glyph(tokens[pos], font, lookup))
-				print(tokens[:pos])
-				print(filter_list(tokens[:pos], lambda t : filter_glyph(t, font, lookup)))
-				print(tokens[pos:])
-				print(filter_list(tokens[pos:], lambda t : filter_glyph(t, font, lookup)))
-		return pos < len(tokens) and \
-			equiv(tokens[pos], self.inputs[0]) and \
-			is_suffix_of(self.lefts, filter_list(tokens[:pos], \
-				lambda t : filter_glyph(t, font, lookup))) and \
-			is_prefix_of(self.inputs[1:] + self.rights, filter_list(tokens[pos+1:], \
-				lambda t : filter_glyph(t, font, lookup)))
+		if pos >= len(tokens) or tokens[pos] not in self.input_sets[0]:
+			return False
+		view = filtered_view(tokens, font, lookup)
+		last_input = match_right(self.input_sets[1:], view, pos)
+		return last_input is not None and \
+			match_right(self.right_sets, view, last_input) is not None and \
+			match_left(self.left_sets, view, pos) is not None
 
 	def apply(self, tokens, pos, font, lookup):
 		# ChainSubstitution3 should not directly modify tokens
 		# Instead, it triggers recursive lookups which handle the actual substitutions
-		posses = self.filtered_input_positions(tokens, pos, font, lookup)
-		return tokens, 0, posses
+		return self.filtered_input_positions(tokens, pos, font, lookup)
 
 	def filtered_input_positions(self, tokens, pos, font, lookup):
+		view = filtered_view(tokens, font, lookup)
 		posses = [pos]
-		for p in range(pos+1, len(tokens)):
-			if filter_glyph(tokens[p], font, lookup):
-				posses.append(p)
-		return posses[:len(self.inputs)]
+		while len(posses) < len(self.inputs):
+			p = view.next(posses[-1])
+			if p < 0:
+				break
+			posses.append(p)
+		return posses
 
 	def __str__(self):
 		lefts = ' '.join([l if isinstance(l, str) else '/'.join(l) for l in self.lefts])
@@ -190,6 +253,58 @@ class ChainSubstitution3:
 		refs = ' '.join([str(index) + '->' + str(lookup) for (index, lookup) in self.refs])
 		return lefts + '|' + inputs + '|' + rights + ' ---> ' + refs
 
+# All chain rules of a lookup as one matcher. Rule i is bit i, in the order
+# in which the rules are attempted. For the k-th unskipped glyph after pos
+# (the input and lookahead, pos itself being the 0th), resp. before pos (the
+# backtrack, nearest first), a glyph is mapped to the bits of the rules whose
+# k-th element covers it. Walking outwards from pos, the bits of the rules
+# still needing a glyph at that distance are and-ed with those of the glyph
+# there, until no rule needs more. The lowest bit left is the rule to apply.
+class ChainAutomaton:
+	def __init__(self, substitutions):
+		self.substitutions = substitutions
+		forwards = [s.input_sets + s.right_sets for s in substitutions]
+		backwards = [list(reversed(s.left_sets)) for s in substitutions]
+		self.forward, self.forward_needed = self.symbols(forwards)
+		self.backward, self.backward_needed = self.symbols(backwards)
+
+	# For each distance, the bits of the glyphs, and the bits of the rules
+	# with an element at that distance.
+	def symbols(self, sequences):
+		length = max([len(seq) for seq in sequences], default=0)
+		glyph_bits = [{} for k in range(length)]
+		needed = [0] * length
+		for i, seq in enumerate(sequences):
+			for k, id_set in enumerate(seq):
+				needed[k] |= 1 << i
+				for id in id_set:
+					glyph_bits[k][id] = glyph_bits[k].get(id, 0) | 1 << i
+		return glyph_bits, needed
+
+	def first_match(self, tokens, pos, view):
+		alive = self.forward[0].get(tokens[pos], 0)
+		p = pos
+		for glyph_bits, needed in zip(self.forward[1:], self.forward_needed[1:]):
+			if alive & needed == 0:
+				break
+			p = view.next(p)
+			if p < 0:
+				alive &= ~needed
+				break
+			alive &= glyph_bits.get(tokens[p], 0) | ~needed
+		p = pos
+		for glyph_bits, needed in zip(self.backward, self.backward_needed):
+			if alive & needed == 0:
+				break
+			p = view.prev(p)
+			if p < 0:
+				alive &= ~needed
+				break
+			alive &= glyph_bits.get(tokens[p], 0) | ~needed
+		if alive == 0:
+			return None
+		return self.substitutions[(alive & -alive).bit_length() - 1]
+
 # Type 8
 class ReverseSubstitution:
 	def __init__(self, lefts, inputs, rights, outputs):
@@ -201,18 +316,37 @@ class ReverseSubstitution:
 	def length(self):
 		return len(self.lefts) + 1 + len(self.rights)
 
+	# The inputs are a coverage, and outputs the glyph for each of them
+	def first_glyphs(self):
+		return self.inputs
+
+	def compile(self, font):
+		self.left_sets = [glyph_id_set(left, font) for left in self.lefts]
+		self.right_sets = [glyph_id_set(right, font) for right in self.rights]
+		self.input_to_output = {font.glyph_id(input): font.glyph_id(output) \
+			for input, output in zip(self.inputs, self.outputs)}
+
 	def recur(self, tokens, pos, font, lookup):
 		return None
 
+	# In a pass from right to left, the backtrack is matched against glyphs
+	# not yet visited and the lookahead against glyphs already substituted.
 	def applicable(self, tokens, pos, font, lookup):
-		return False
+		if pos >= len(tokens) or tokens[pos] not in self.input_to_output:
+			return False
+		view = filtered_view(tokens, font, lookup)
+		return match_right(self.right_sets, view, pos) is not None and \
+			match_left(self.left_sets, view, pos) is not None
 
 	def apply(self, tokens, pos, font, lookup):
-		print("Type 8 not implemented")
-		exit(0)
+		tokens.replace(1, [self.input_to_output[tokens[pos]]])
+		return [pos]
 
 	def __str__(self):
-		return ' '.join(self.inputs) + ' -> ' + self.output
+		lefts = ' '.join([l if isinstance(l, str) else '/'.join(l) for l in self.lefts])
+		rights = ' '.join([l if isinstance(l, str) else '/'.join(l) for l in self.rights])
+		subs = ' '.join([input + '->' + output for input, output in zip(self.inputs, self.outputs)])
+		return lefts + '|' + subs + '|' + rights
 
 class GSUB_Lookup:
 	def __init__(self, index, typ):
@@ -225,55 +359,212 @@ class GSUB_Lookup:
 		self.mark_class = 0
 		self.filter_set = None
 		self.substitutions = []
+		self.mask = None
+		self.first_to_subs = None
+		self.triggers = None
+		self.trie = None
+		self.automaton = None
+		self.batch_rules = None
+		self.batch_size = None
 
 	def add(self, substitution):
 		self.substitutions.append(substitution)
+		self.first_to_subs = None
 
 	# Normally one shouldn't use this. The textual order should be the order
 	# in which rules are attempted.
 	def reorder(self):
 		self.substitutions = sorted(self.substitutions, key=lambda s : s.length())
-
+		self.first_to_subs = None
+
+	# Translate the rules to glyph IDs and index them by the glyphs they can
+	# start at, each list in the order in which apply_at attempts them:
+	# longest first, then textual order. A lookup of only ligatures is
+	# moreover put in a trie, and one of only chain rules in an automaton.
+	def compile(self, font):
+		first_to_subs = {}
+		substitutions = sorted(self.substitutions, key=lambda s : -s.length())
+		for substitution in substitutions:
+			substitution.compile(font)
+			for first in substitution.first_glyphs():
+				subs = first_to_subs.setdefault(font.glyph_id(first), [])
+				if len(subs) == 0 or subs[-1] is not substitution:
+					subs.append(substitution)
+		self.first_to_subs = first_to_subs
+		# The glyphs that can trigger the lookup in a pass. Those of the
+		# lookups a chain refers to need not be present beforehand, as these
+		# are only applied within a match of the chain.
+		self.triggers = frozenset(first_to_subs)
+		self.trie = None
+		self.automaton = None
+		if len(substitutions) > 0 and all(isinstance(s, LigSubstitution) for s in substitutions):
+			self.trie = LigatureTrie()
+			for substitution in substitutions:
+				self.trie.add(substitution)
+		elif len(substitutions) > 0 and all(isinstance(s, ChainSubstitution3) for s in substitutions):
+			self.automaton = ChainAutomaton(substitutions)
+		# A lookup of only single and multiple substitutions maps each glyph to
+		# glyphs, by the first rule for it
+		self.batch_rules = None
+		self.batch_size = None
+		if not self.reverse and len(substitutions) > 0 and \
+				all(isinstance(s, (SingleSubstitution1, MultSubstitution)) for s in substitutions):
+			self.batch_rules = [subs[0] for subs in first_to_subs.values()]
+
+	# One pass over the buffer. A rule that applies moves the cursor past the
+	# glyphs it produced; otherwise the cursor moves on by one glyph. Glyphs
+	# no rule starts at are passed over at once.
 	def apply(self, tokens, font):
-		pos = 0
+		if self.first_to_subs is None:
+			self.compile(font)
 		applications = []
-		while pos < len(tokens):
-			tokens, application, jump = self.apply_at(tokens, pos, font)
+		if self.triggers.isdisjoint(tokens.present):
+			return applications
+		tokens.clear_output()
+		if self.reverse:
+			return self.apply_reverse(tokens, font, applications)
+		if self.batch_rules is not None and tokens.history is None and \
+				(font.hooks is None or not font.hooks.per_position) and len(tokens) >= subst_batch_min_length:
+			batch_applications = self.apply_batch(tokens, font)
+			if batch_applications is not None:
+				return batch_applications
+		while tokens.skip_to(self.first_to_subs):
+			application = self.apply_at(tokens, tokens.position(), font)
 			if application is not None:
 				applications.append(application)
-				pos += jump
 			else:
-				pos += 1
-		return tokens, applications
+				tokens.next_glyph()
+		tokens.swap()
+		return applications
+
+	# Tables by glyph ID (cf. GPOS_Lookup.compile_batch) of the rule for the
+	# glyph, and of its outputs: as one glyph each if all rules have one,
+	# else as their number and where they start in one array of all.
+	def compile_batch(self, font):
+		size = len(font.glyph_names)
+		self.batch_rule = id_table({rule.input_id: i for i, rule in enumerate(self.batch_rules)}, size)
+		outputs = [[rule.output_id] if isinstance(rule, SingleSubstitution1) else rule.output_ids \
+			for rule in self.batch_rules]
+		self.batch_outputs = outputs
+		if all(len(output_ids) == 1 for output_ids in outputs):
+			self.batch_table = np.arange(size, dtype=np.int64)
+			for rule, output_ids in zip(self.batch_rules, outputs):
+				self.batch_table[rule.input_id] = output_ids[0]
+		else:
+			self.batch_table = None
+			self.batch_lengths = np.ones(size, dtype=np.int64)
+			self.batch_offsets = np.zeros(size, dtype=np.int64)
+			flat = []
+			for rule, output_ids in zip(self.batch_rules, outputs):
+				self.batch_lengths[rule.input_id] = len(output_ids)
+				self.batch_offsets[rule.input_id] = len(flat)
+				flat.extend(output_ids)
+			# never read for a glyph without rule, but keeps the gather in range
+			self.batch_flat = np.array(flat + [0], dtype=np.int64)
+		self.batch_size = size
+
+	# One pass as by apply, in one go: a gather from the table of outputs,
+	# or, with multiple substitutions, a gather of each output glyph from
+	# the outputs of the glyph it comes from, which gives its cluster too.
+	# Returns the applications, or None if the sequence has glyphs too new
+	# for the tables.
+	def apply_batch(self, tokens, font):
+		if self.batch_size != len(font.glyph_names):
+			self.compile_batch(font)
+		# A view of the glyphs, which are replaced, not changed, below
+		ids = np.frombuffer(tokens.info, dtype=np.uint16)
+		if ids.max() >= self.batch_size:
+			return None
+		rules = self.batch_rule[ids]
+		positions = np.flatnonzero(rules >= 0)
+		if len(positions) == 0:
+			return []
+		applied = rules[positions].tolist()
+		if self.batch_table is not None:
+			glyphs = self.batch_table[ids]
+			clusters = tokens.info_clusters
+			starts = positions
+		else:
+			lengths = self.batch_lengths[ids]
+			sources = np.repeat(np.arange(len(ids)), lengths)
+			ends = np.cumsum(lengths)
+			firsts = ends - lengths
+			source_ids = ids[sources]
+			glyphs = np.where(rules[sources] >= 0, \
+				self.batch_flat[self.batch_offsets[source_ids] + np.arange(len(sources)) - firsts[sources]], \
+				source_ids)
+			clusters = array('I', np.frombuffer(tokens.info_clusters, dtype=np.uint32)[sources].tobytes())
+			starts = firsts[positions]
+		for rule in set(applied):
+			tokens.present.update(self.batch_outputs[rule])
+		tokens.replace_all(array('H', glyphs.astype(np.uint16).tobytes()), clusters)
+		index = str(self.index)
+		return [Application(index, [start], self.batch_rules[rule], None) \
+			for start, rule in zip(starts.tolist(), applied)]
+
+	# One pass from the last glyph to the first (Type 8). The rules replace
+	# one glyph by one, so positions stay put; the cursor is only moved back
+	# to the glyphs some rule starts at.
+	def apply_reverse(self, tokens, font, applications):
+		first_to_subs = self.first_to_subs
+		for pos in range(len(tokens)-1, -1, -1):
+			if tokens[pos] in first_to_subs:
+				application = self.apply_at(tokens, pos, font)
+				if application is not None:
+					applications.append(application)
+		tokens.swap()
+		return applications
 
 	def apply_at(self, tokens, pos, font):
-		for substitution in sorted(self.substitutions, key=lambda s : -s.length()):
-			if substitution.applicable(tokens, pos, font, self):
-				recur = substitution.recur(tokens, pos, font, self)
-				if recur is not None:
-					if len(recur) > 0:
-						posses = substitution.filtered_input_positions(tokens, pos, font, self)
-						len_pre = len(tokens)
-						application = {'index': str(self.index), 'posses': posses, 'rule': substitution, \
-							'tokens': tokens}
-						for pos2, recurred in recur:
-							recur_lookup = font.GSUB_lookups[recurred]
-							tokens, application_recur, _ = recur_lookup.apply_at(tokens, pos2, font)
-							if application_recur is not None:
-								application['index'] += '/' + application_recur['index']
-						application['tokens'] = tokens
-						len_post = len(tokens)
-						jump = len_post-len_pre + 1
-					else:
-						application = {'index': str(self.index), 'posses': [pos], 'rule': substitution, \
-							'tokens': tokens} 
-						jump = 1
-				else:
-					tokens, jump, posses = substitution.apply(tokens, pos, font, self)
-					application = {'index': str(self.index), 'posses': posses, 'rule': substitution, \
-						'tokens': tokens}
-				return tokens, application, jump
-		return tokens, None, 0
+		if pos >= len(tokens):
+			return None
+		if self.first_to_subs is None:
+			self.compile(font)
+		hooks = font.hooks
+		if hooks is not None:
+			hooks.position_visited(self, pos)
+		tokens.move_to(pos)
+		substitution = None
+		if self.trie is not None:
+			if hooks is not None:
+				hooks.rule_tried(self, None, pos)
+			substitution = self.trie.longest_match(tokens, pos, filtered_view(tokens, font, self))
+		elif self.automaton is not None:
+			if hooks is not None:
+				hooks.rule_tried(self, None, pos)
+			substitution = self.automaton.first_match(tokens, pos, filtered_view(tokens, font, self))
+		else:
+			for candidate in self.first_to_subs.get(tokens[pos], []):
+				if hooks is not None:
+					hooks.rule_tried(self, candidate, pos)
+				if candidate.applicable(tokens, pos, font, self):
+					substitution = candidate
+					break
+		if substitution is None:
+			return None
+		if hooks is not None:
+			hooks.rule_matched(self, substitution, pos)
+		index = str(self.index)
+		recur = substitution.recur(tokens, pos, font, self)
+		if recur is not None:
+			if len(recur) > 0:
+				posses = substitution.filtered_input_positions(tokens, pos, font, self)
+				len_pre = len(tokens)
+				for pos2, recurred in recur:
+					recur_lookup = font.GSUB_lookups[recurred]
+					if hooks is not None:
+						hooks.recursion(self, recur_lookup, pos2)
+					application_recur = recur_lookup.apply_at(tokens, pos2, font)
+					if application_recur is not None:
+						index += '/' + application_recur.index
+				len_post = len(tokens)
+				tokens.move_to(pos + len_post-len_pre + 1)
+			else:
+				posses = [pos]
+				tokens.next_glyph()
+		else:
+			posses = substitution.apply(tokens, pos, font, self)
+		return Application(index, posses, substitution, tokens.history)
 
 	def __str__(self):
 		s = 'GSUB LOOKUP ' + str(self.index)
@@ -292,6 +583,75 @@ class GSUB_Lookup:
 			s += '\n' + sub
 		return s
 
+# For each position of a sequence of glyph IDs, the nearest position before
+# it whose glyph is in glyphs and kept by the filter mask, or -1; found in
+# one pass from left to right.
+def last_attachable(tokens, glyphs, mask):
+	last = array('i', [-1]) * len(tokens)
+	current = -1
+	for pos, glyph in enumerate(tokens):
+		last[pos] = current
+		if glyph in glyphs and mask[glyph]:
+			current = pos
+	return last
+
+# The batch evaluation of GPOS lookups (cf. GPOS_Lookup.apply_batch) works
+# on arrays indexed by glyph ID, for IDs below size, the number of glyphs
+# when the lookup is prepared for it.
+
+# Array mapping glyph IDs to indexes, -1 for those not in mapping
+def id_table(mapping, size):
+	table = np.full(size, -1, dtype=np.int64)
+	if len(mapping) > 0:
+		table[np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping))] = \
+			np.fromiter(mapping.values(), dtype=np.int64, count=len(mapping))
+	return table
+
+# As last_attachable, for all positions, where eligible tells which glyphs
+# can be attached to
+def last_attachable_batch(eligible):
+	where = np.where(eligible, np.arange(len(eligible)), -1)
+	last = np.full(len(eligible), -1, dtype=np.int64)
+	if len(eligible) > 1:
+		last[1:] = np.maximum.accumulate(where)[:-1]
+	return last
+
+# Tables of the marks of an attachment: the index of the class of each, its
+# anchor and whether it has one, and of the anchors of the glyphs it is
+# attached to, by their index and that of the class. The last class index
+# is that of marks without class, which have no anchor on any glyph.
+def attachment_tables(marks, targets):
+	classes = sorted(set(mark['class'] for mark in marks if 'class' in mark))
+	class_index = {cl: i for i, cl in enumerate(classes)}
+	mark_class = np.array([class_index.get(mark.get('class'), len(classes)) for mark in marks], \
+		dtype=np.int64)
+	mark_anchor = np.array([(mark.get('x', 0), mark.get('y', 0)) for mark in marks], \
+		dtype=np.int64).reshape(len(marks), 2)
+	mark_given = np.array(['x' in mark and 'y' in mark for mark in marks], dtype=np.bool_)
+	anchors = np.zeros((len(targets), len(classes) + 1, 2), dtype=np.int64)
+	anchors_given = np.zeros((len(targets), len(classes) + 1), dtype=np.bool_)
+	for t, target in enumerate(targets):
+		for cl, coords in target.get('coordinates', {}).items():
+			if cl in class_index and 'x' in coords and 'y' in coords:
+				anchors[t, class_index[cl]] = (coords['x'], coords['y'])
+				anchors_given[t, class_index[cl]] = True
+	return mark_class, mark_anchor, mark_given, anchors, anchors_given
+
+# Attach the marks at positions to the glyphs at targets, with mark_indexes
+# and target_indexes into the tables (cf. attachment_tables).
+def attach_batch(tables, positionings, positions, mark_indexes, target_indexes):
+	mark_class, mark_anchor, mark_given, anchors, anchors_given = tables
+	classes = mark_class[mark_indexes]
+	given = mark_given[mark_indexes] & anchors_given[target_indexes, classes]
+	offsets = anchors[target_indexes, classes] - mark_anchor[mark_indexes]
+	positionings.scatter('XCoordinate', positions[given], offsets[given, 0])
+	positionings.scatter('YCoordinate', positions[given], offsets[given, 1])
+
+# The shortest sequence for which GPOS_Lookup.apply_batch is used, resp.
+# GSUB_Lookup.apply_batch
+batch_min_length = 32
+subst_batch_min_length = 128
+
 # Type 1
 class SingleAdjustment:
 	def __init__(self, form, adjustments):
@@ -301,6 +661,18 @@ class SingleAdjustment:
 	def length(self):
 		return 1
 
+	# The placement of each glyph, by glyph ID. A glyph listed twice gets
+	# the placements of both, the later taking precedence.
+	def compile(self, font):
+		self.glyph_to_placement = {}
+		for adjs in self.adjustments:
+			placement = self.glyph_to_placement.setdefault(font.glyph_id(adjs.get('glyph')), {})
+			placement.update(adjs.get('placement', {}))
+
+	# The glyph IDs the rule can apply at
+	def first_ids(self):
+		return self.glyph_to_placement.keys()
+
 	def recur(self):
 		return None
 
@@ -308,30 +680,43 @@ class SingleAdjustment:
 		# guard bounds
 		if pos < 0 or pos >= len(tokens):
 			return False
-		# adjustments are dicts with key 'glyph'
-		for adj in self.adjustments:
-			if adj.get('glyph') == tokens[pos]:
-				return True
-		return False
+		return tokens[pos] in self.glyph_to_placement
 
 	def apply(self, tokens, positionings, pos, font, lookup):
-		# positionings is list of per-glyph dicts; copy list and per-glyph dict safely
-		positionings = [ (d.copy() if isinstance(d, dict) else {}) for d in positionings ]
 		if pos < 0 or pos >= len(positionings):
 			return positionings
-		for adjs in self.adjustments:
-			if adjs.get('glyph') == tokens[pos]:
-				placement = adjs.get('placement', {})
-				# ensure dict exists for this token
-				if positionings[pos] is None:
-					positionings[pos] = {}
-				# Map Value names (XPlacement/YPlacement) to runtime coords (XCoordinate/YCoordinate)
-				if 'XPlacement' in placement:
-					positionings[pos]['XCoordinate'] = placement['XPlacement']
-				if 'YPlacement' in placement:
-					positionings[pos]['YCoordinate'] = placement['YPlacement']
+		placement = self.glyph_to_placement.get(tokens[pos], {})
+		# Map Value names (XPlacement/YPlacement) to runtime coords (XCoordinate/YCoordinate)
+		if 'XPlacement' in placement:
+			positionings.set_value(pos, 'XCoordinate', placement['XPlacement'])
+		if 'YPlacement' in placement:
+			positionings.set_value(pos, 'YCoordinate', placement['YPlacement'])
+		if 'XAdvance' in placement:
+			positionings.set_value(pos, 'XAdvance', placement['XAdvance'])
 		return positionings
 
+	def compile_batch(self, font, size):
+		glyphs = list(self.glyph_to_placement)
+		self.batch_index = id_table({glyph: i for i, glyph in enumerate(glyphs)}, size)
+		self.batch_values = {}
+		for name, key in [('XPlacement', 'XCoordinate'), ('YPlacement', 'YCoordinate'), ('XAdvance', 'XAdvance')]:
+			placements = [self.glyph_to_placement[glyph] for glyph in glyphs]
+			given = np.array([name in placement for placement in placements], dtype=np.bool_)
+			values = np.array([placement.get(name, 0) for placement in placements], dtype=np.int64)
+			self.batch_values[key] = (given, values)
+
+	# Applies the rule at the candidate positions it applies at, given the
+	# glyph IDs of the sequence. Returns at which positions it applied.
+	def apply_batch(self, ids, candidates, mask, positionings):
+		indexes = self.batch_index[ids]
+		applied = candidates & (indexes >= 0)
+		positions = np.flatnonzero(applied)
+		indexes = indexes[positions]
+		for key, (given, values) in self.batch_values.items():
+			selected = given[indexes]
+			positionings.scatter(key, positions[selected], values[indexes[selected]])
+		return applied
+
 	def __str__(self):
 		return ' '.join([str((g,a)) for (g,a) in self.adjustments])
 
@@ -344,6 +729,24 @@ class MarkBaseAttachment:
 	def length(self):
 		return 2
 
+	# The index in marks, resp. bases, of each glyph ID; the first if the
+	# glyph is listed twice
+	def compile(self, font):
+		self.mark_to_index = {}
+		for index, mark in enumerate(self.marks):
+			self.mark_to_index.setdefault(font.glyph_id(mark['glyph']), index)
+		self.base_to_index = {}
+		for index, base in enumerate(self.bases):
+			self.base_to_index.setdefault(font.glyph_id(base.get('glyph')), index)
+		self.base_glyphs = frozenset(id for id in self.base_to_index \
+			if font.glyph_classes[id] == BASE_GLYPH)
+		self.last_tokens = None
+		self.last_lookup = None
+		self.last_base = None
+
+	def first_ids(self):
+		return self.mark_to_index.keys()
+
 	def recur(self):
 		return None
 
@@ -353,8 +756,6 @@ class MarkBaseAttachment:
 		return mark_index >= 0 and base_index >= 0
 
 	def apply(self, tokens, positionings, pos, font, lookup):
-		# copy list and per-glyph dicts safely
-		positionings = [ (d.copy() if isinstance(d, dict) else {}) for d in positionings ]
 		mark_index = self.mark(tokens, pos, font, lookup)
 		pos_base, base_index = self.base(tokens, pos, font, lookup)
 		if mark_index < 0 or pos_base < 0 or base_index < 0:
@@ -362,40 +763,47 @@ class MarkBaseAttachment:
 		mark = self.marks[mark_index]
 		base = self.bases[base_index]
 		cl = mark['class']
-		# ensure dicts exist
-		if positionings[pos] is None:
-			positionings[pos] = {}
-		if positionings[pos_base] is None:
-			positionings[pos_base] = {}
 		# defensive coordinate lookup (class may be missing)
 		coords = base.get('coordinates', {}).get(cl)
 		if coords is not None and 'x' in coords and 'y' in coords and 'x' in mark and 'y' in mark:
-			positionings[pos]['XCoordinate'] = coords['x'] - mark['x']
-			positionings[pos]['YCoordinate'] = coords['y'] - mark['y']
+			positionings.set_value(pos, 'XCoordinate', coords['x'] - mark['x'])
+			positionings.set_value(pos, 'YCoordinate', coords['y'] - mark['y'])
 		# otherwise leave positionings unchanged
 		return positionings
 
+	def compile_batch(self, font, size):
+		self.batch_mark = id_table(self.mark_to_index, size)
+		self.batch_base = id_table({id: self.base_to_index[id] for id in self.base_glyphs}, size)
+		self.batch_tables = attachment_tables(self.marks, self.bases)
+
+	# cf. SingleAdjustment.apply_batch
+	def apply_batch(self, ids, candidates, mask, positionings):
+		mark_indexes = self.batch_mark[ids]
+		base_indexes = self.batch_base[ids]
+		last = last_attachable_batch((base_indexes >= 0) & mask[ids])
+		applied = candidates & (mark_indexes >= 0) & (last >= 0)
+		positions = np.flatnonzero(applied)
+		attach_batch(self.batch_tables, positionings, positions, mark_indexes[positions], \
+			base_indexes[last[positions]])
+		return applied
+
 	def mark(self, tokens, pos, font, lookup):
-		for index, mark in enumerate(self.marks):
-			if mark['glyph'] == tokens[pos]:
-				return index
-		return -1
+		return self.mark_to_index.get(tokens[pos], -1)
 
+	# The nearest glyph to the left that is not filtered out by lookup, is
+	# classified as a base glyph and is in the base coverage. The nearest
+	# for every position is found at once, and kept as long as the glyphs
+	# are the same, as positioning does not change them.
 	def base(self, tokens, pos, font, lookup):
-		# Search to the left for a base glyph that is not filtered out by lookup
-		for i in range(pos-1, -1, -1):
-			tok = tokens[i]
-			# respect lookup filtering (ignore flags, mark class, filter sets)
-			if not filter_glyph(tok, font, lookup):
-				continue
-			# must be classified as a base glyph
-			if font.glyph_to_class.get(tok) != BASE_GLYPH:
-				continue
-			# match against the declared BaseCoverage entries
-			for index, base in enumerate(self.bases):
-				if base.get('glyph') == tok:
-					return i, index
-		return -1, -1
+		snapshot = tokens.snapshot()
+		if snapshot is not self.last_tokens or lookup is not self.last_lookup:
+			self.last_base = last_attachable(snapshot, self.base_glyphs, lookup.mask)
+			self.last_tokens = snapshot
+			self.last_lookup = lookup
+		i = self.last_base[pos]
+		if i < 0:
+			return -1, -1
+		return i, self.base_to_index[snapshot[i]]
 
 	def __str__(self):
 		return f'(1) {str(self.marks)} (2) {str(self.bases)}'
@@ -409,6 +817,21 @@ class MarkMarkAttachment:
 	def length(self):
 		return 2
 
+	# The index in marks1, resp. marks2, of each glyph ID (cf. MarkBaseAttachment)
+	def compile(self, font):
+		self.mark1_to_index = {}
+		for index, mark in enumerate(self.marks1):
+			self.mark1_to_index.setdefault(font.glyph_id(mark['glyph']), index)
+		self.mark2_to_index = {}
+		for index, mark in enumerate(self.marks2):
+			self.mark2_to_index.setdefault(font.glyph_id(mark.get('glyph')), index)
+		self.last_tokens = None
+		self.last_lookup = None
+		self.last_mark2 = None
+
+	def first_ids(self):
+		return self.mark1_to_index.keys()
+
 	def recur(self):
 		return None
 
@@ -418,8 +841,6 @@ class MarkMarkAttachment:
 		return mark1_index >= 0 and mark2_index >= 0
 
 	def apply(self, tokens, positionings, pos, font, lookup):
-		# copy list and per-glyph dicts safely
-		positionings = [ (d.copy() if isinstance(d, dict) else {}) for d in positionings ]
 		mark1_index = self.mark1(tokens, pos, font, lookup)
 		pos_mark2, mark2_index = self.mark2(tokens, pos, font, lookup)
 		if mark1_index < 0 or pos_mark2 < 0 or mark2_index < 0:
@@ -427,34 +848,46 @@ class MarkMarkAttachment:
 		mark1 = self.marks1[mark1_index]
 		mark2 = self.marks2[mark2_index]
 		cl = mark1.get('class')
-		# ensure dicts exist
 		if pos < 0 or pos >= len(positionings):
 			return positionings
-		if positionings[pos] is None:
-			positionings[pos] = {}
 		# defensive coordinate lookup
 		coords = mark2.get('coordinates', {}).get(cl) if cl is not None else None
 		if coords is not None and 'x' in coords and 'y' in coords and 'x' in mark1 and 'y' in mark1:
-			positionings[pos]['XCoordinate'] = coords['x'] - mark1['x']
-			positionings[pos]['YCoordinate'] = coords['y'] - mark1['y']
+			positionings.set_value(pos, 'XCoordinate', coords['x'] - mark1['x'])
+			positionings.set_value(pos, 'YCoordinate', coords['y'] - mark1['y'])
 		return positionings
 
+	def compile_batch(self, font, size):
+		self.batch_mark1 = id_table(self.mark1_to_index, size)
+		self.batch_mark2 = id_table(self.mark2_to_index, size)
+		self.batch_tables = attachment_tables(self.marks1, self.marks2)
+
+	# cf. SingleAdjustment.apply_batch
+	def apply_batch(self, ids, candidates, mask, positionings):
+		mark1_indexes = self.batch_mark1[ids]
+		mark2_indexes = self.batch_mark2[ids]
+		last = last_attachable_batch((mark2_indexes >= 0) & mask[ids])
+		applied = candidates & (mark1_indexes >= 0) & (last >= 0)
+		positions = np.flatnonzero(applied)
+		attach_batch(self.batch_tables, positionings, positions, mark1_indexes[positions], \
+			mark2_indexes[last[positions]])
+		return applied
+
 	def mark1(self, tokens, pos, font, lookup):
-		for index, mark in enumerate(self.marks1):
-			if mark['glyph'] == tokens[pos]:
-				return index
-		return -1
+		return self.mark1_to_index.get(tokens[pos], -1)
 
+	# The nearest glyph to the left that passes lookup filtering and is in
+	# the marks2 coverage (cf. MarkBaseAttachment.base)
 	def mark2(self, tokens, pos, font, lookup):
-		# Search leftwards for a candidate mark2 that passes lookup filtering and matches marks2 coverage
-		for i in range(pos-1, -1, -1):
-			tok = tokens[i]
-			if not filter_glyph(tok, font, lookup):
-				continue
-			for index, mark in enumerate(self.marks2):
-				if mark.get('glyph') == tok:
-					return i, index
-		return -1, -1
+		snapshot = tokens.snapshot()
+		if snapshot is not self.last_tokens or lookup is not self.last_lookup:
+			self.last_mark2 = last_attachable(snapshot, self.mark2_to_index, lookup.mask)
+			self.last_tokens = snapshot
+			self.last_lookup = lookup
+		i = self.last_mark2[pos]
+		if i < 0:
+			return -1, -1
+		return i, self.mark2_to_index[snapshot[i]]
 
 	def __str__(self):
 		return f'(1) {str(self.marks1)} (2) {str(self.marks2)}'
@@ -470,28 +903,28 @@ class ChainPos:
 	def length(self):
 		return len(self.left) + 1 + len(self.right)
 
+	def compile(self, font):
+		# accept input that may be flat list or list-of-coverages
+		self.input_ids = set()
+		if self.input is not None:
+			for elem in self.input:
+				self.input_ids |= glyph_id_set(elem, font)
+		self.left_sets = [glyph_id_set(left, font) for left in self.left]
+		self.input_right_sets = [glyph_id_set(elem, font) for elem in self.input + self.right] \
+			if self.input is not None else []
+
+	def first_ids(self):
+		return self.input_ids
+
 	def recur(self):
 		return self.output
 
 	def applicable(self, tokens, pos, font, lookup):
-		# accept input that may be flat list or list-of-coverages
-		def input_contains(tok):
-			if self.input is None:
-				return False
-			# if input is a list-of-lists (coverage entries)
-			if len(self.input) > 0 and isinstance(self.input[0], list):
-				for cov in self.input:
-					if tok in cov:
-						return True
-				return False
-			# otherwise flat list
-			return tok in self.input
-
-		return input_contains(tokens[pos]) and \
-			is_suffix_of(self.left, filter_list(tokens[:pos], \
-				lambda t : filter_glyph(t, font, lookup))) and \
-			is_prefix_of(self.input + self.right, filter_list(tokens[pos:], \
-				lambda t : filter_glyph(t, font, lookup)))
+		if tokens[pos] not in self.input_ids:
+			return False
+		view = filtered_view(tokens, font, lookup)
+		return match_right(self.input_right_sets, view, pos-1) is not None and \
+			match_left(self.left_sets, view, pos) is not None
 
 	def apply(self, tokens, positionings, pos, font, lookup):
 		return positionings
@@ -509,28 +942,112 @@ class GPOS_Lookup:
 		self.mark_class = 0
 		self.filter_set = None
 		self.positionings = []
+		self.mask = None
+		self.compiled = False
+		self.first_to_posits = None
+		self.triggers = None
+		self.batch_posits = None
+		self.batch_mask = None
+		self.batch_source = None
 
 	def add_positioning(self, positioning):
 		self.positionings.append(positioning)
+		self.compiled = False
 
 	# Normally one shouldn't use this. The textual order should be the order
 	# in which rules are attempted.
 	def reorder(self):
 		self.positionings = sorted(self.positionings, key=lambda s : s.length())
 
+	# Index the rules by the glyph IDs they can apply at, each list in the
+	# order in which apply_at attempts them: shortest first, then textual
+	# order.
+	def compile(self, font):
+		first_to_posits = {}
+		for posit in sorted(self.positionings, key=lambda s: s.length()):
+			posit.compile(font)
+			for first in posit.first_ids():
+				posits = first_to_posits.setdefault(first, [])
+				if len(posits) == 0 or posits[-1] is not posit:
+					posits.append(posit)
+		self.first_to_posits = first_to_posits
+		self.triggers = frozenset(first_to_posits)
+		# Rules whose outcome at a position depends only on the glyphs, and
+		# not on other rules, can be applied at all positions at once
+		posits = sorted(self.positionings, key=lambda s: s.length())
+		if len(posits) > 0 and all(isinstance(posit, (SingleAdjustment, MarkBaseAttachment, \
+				MarkMarkAttachment)) for posit in posits):
+			self.batch_posits = posits
+		else:
+			self.batch_posits = None
+		self.batch_source = None
+		self.compiled = True
+
+	# Only the positions of glyphs some rule can apply at are visited.
+	# Without history or hooks that observe positions (cf. Hooks.per_position),
+	# a long enough sequence is done by apply_batch if the rules allow it.
 	def apply(self, tokens, positionings, font):
+		if not self.compiled:
+			self.compile(font)
 		applications = []
-		for pos in range(len(tokens)):
-			positionings, application = self.apply_at(tokens, positionings, pos, font)
-			if application is not None:
-				applications.append(application)
+		if self.triggers.isdisjoint(tokens.present):
+			return positionings, applications
+		if self.batch_posits is not None and tokens.history is None and \
+				(font.hooks is None or not font.hooks.per_position) and \
+				len(tokens) >= batch_min_length and isinstance(positionings, PositionBuffer):
+			applications = self.apply_batch(tokens, positionings, font)
+			if applications is not None:
+				return positionings, applications
+			applications = []
+		first_to_posits = self.first_to_posits
+		for pos, glyph in enumerate(tokens.snapshot()):
+			if glyph in first_to_posits:
+				positionings, application = self.apply_at(tokens, positionings, pos, font)
+				if application is not None:
+					applications.append(application)
 		return positionings, applications
 
+	# The tables of the rules, by glyph ID, are made for the glyphs the font
+	# has at the time, and again if the filter mask changes or grows.
+	def compile_batch(self, font):
+		size = len(self.mask)
+		for posit in self.batch_posits:
+			posit.compile_batch(font, size)
+		self.batch_mask = np.frombuffer(bytes(self.mask), dtype=np.uint8).astype(np.bool_)
+		self.batch_source = (self.mask, size)
+
+	# Applies the lookup at all positions at once, each rule in turn where
+	# no earlier rule applied, as apply_at would. Returns the applications,
+	# in order of position, or None if the sequence has glyphs too new for
+	# the tables.
+	def apply_batch(self, tokens, positionings, font):
+		if self.batch_source is None or self.batch_source[0] is not self.mask or \
+				self.batch_source[1] != len(self.mask):
+			self.compile_batch(font)
+		ids = np.array(tokens.snapshot(), dtype=np.int64)
+		if ids.max() >= len(self.batch_mask):
+			return None
+		rules = np.full(len(ids), -1, dtype=np.int64)
+		for i, posit in enumerate(self.batch_posits):
+			applied = posit.apply_batch(ids, rules < 0, self.batch_mask, positionings)
+			rules[applied] = i
+		index = str(self.index)
+		return [Application(index, [pos], self.batch_posits[rules[pos]], None, positioning=True) \
+			for pos in np.flatnonzero(rules >= 0).tolist()]
+
 	def apply_at(self, tokens, positionings, pos, font):
-		# Iterate positionings in increasing length order (shorter first)
-		for posit in sorted(self.positionings, key=lambda s: s.length()):
+		if not self.compiled:
+			self.compile(font)
+		hooks = font.hooks
+		if hooks is not None:
+			hooks.position_visited(self, pos)
+		for posit in self.first_to_posits.get(tokens[pos], []):
+			if hooks is not None:
+				hooks.rule_tried(self, posit, pos)
 			# pass this lookup (self) into applicable()
 			if posit.applicable(tokens, pos, font, self):
+				if hooks is not None:
+					hooks.rule_matched(self, posit, pos)
 				recur = posit.recur()
 				if recur is not None:
 					# recur is expected to be an index into font.GPOS_lookups
@@ -539,23 +1056,23 @@ class GPOS_Lookup:
 					except Exception:
 						# missing or invalid recursion target: skip this positioning
 						continue
+					if hooks is not None:
+						hooks.recursion(self, recur_lookup, pos)
 					positionings, application = recur_lookup.apply_at(tokens, positionings, pos, font)
 					if application is not None:
-						application['index'] = str(self.index) + '/' + application.get('index', str(recur))
+						application.index = str(self.index) + '/' + application.index
 					else:
-						application = {'index': str(self.index) + '/' + str(recur),
-									   'posses': [pos],
-									   'rule': posit,
-									   'tokens': tokens,
-									   'positionings': positionings}
+						application = Application(str(self.index) + '/' + str(recur), [pos], posit,
+							tokens.history, positioning=True)
 				else:
-					# direct application of this positioning
+					# direct application of this positioning, which only changes
+					# the positioning at pos
+					history = tokens.history
+					before = positionings[pos] if history is not None else None
 					positionings = posit.apply(tokens, positionings, pos, font, self)
-					application = {'index': str(self.index),
-								   'posses': [pos],
-								   'rule': posit,
-								   'tokens': tokens,
-								   'positionings': positionings}
+					if history is not None:
+						history.adjustments.append((pos, before, positionings[pos]))
+					application = Application(str(self.index), [pos], posit, tokens.history, positioning=True)
 				return positionings, application
 		return positionings, None
 
@@ -570,6 +1087,275 @@ class Feature:
 	def __str__(self):
 		return "FEATURE " + self.tag + ' ' + str(self.lookup_indexes)
 
+# The lookups applied for a script when some features are suppressed, in
+# the order of application, each with the tag of its feature.
+class ShapePlan:
+	def __init__(self, font, script, suppressed):
+		self.script = script
+		self.suppressed = suppressed
+		self.GSUB_lookups = []
+		for lookup in font.GSUB_lookup_list:
+			if lookup.index in font.GSUB_lookup_index_to_feature:
+				tag = font.GSUB_lookup_index_to_feature[lookup.index].tag
+				if tag not in suppressed:
+					self.GSUB_lookups.append((lookup, tag))
+		self.GPOS_lookups = []
+		for lookup in font.GPOS_lookup_list:
+			if lookup.index in font.GPOS_lookup_index_to_feature:
+				tag = font.GPOS_lookup_index_to_feature[lookup.index].tag
+				if tag not in suppressed:
+					self.GPOS_lookups.append((lookup, tag))
+		# The longest context of a rule, in glyphs
+		self.context = max([rule.length() for lookup, tag in self.GSUB_lookups \
+			for rule in lookup.substitutions] + [rule.length() for lookup, tag in self.GPOS_lookups \
+			for rule in lookup.positionings] + [1])
+		self.GSUB_reaches = None
+		self.GPOS_reaches = None
+
+	# The reach of each lookup (cf. LookupReach), made when first needed
+	def reaches(self, font):
+		if self.GSUB_reaches is None:
+			self.GSUB_reaches = [LookupReach(lookup, font) for lookup, tag in self.GSUB_lookups]
+			self.GPOS_reaches = [LookupReach(lookup, font) for lookup, tag in self.GPOS_lookups]
+		return self.GSUB_reaches, self.GPOS_reaches
+
+# How far a lookup can see from a position where a rule may start: back,
+# resp. ahead, so many glyphs that its filter mask keeps, however many
+# glyphs are skipped in between, as the backtrack, resp. the rest of the
+# input and the lookahead, of its rules; through the lookups its rules
+# apply, with their own masks, further still. Counted conservatively, a
+# glyph is kept if all the masks of those lookups that see other glyphs
+# keep it. A rule sees a glyph only if the glyphs between match it, so for
+# each distance up to the farthest, onward, resp. backward, holds the
+# glyphs there that some rule may match, as a sorted array of glyph IDs,
+# or None for any glyph. As the glyphs before a trigger may have been
+# changed by the lookup itself, back of a substitution a glyph that some
+# rule may match at any distance is matched, and so are those the lookup
+# may change, its changed glyphs, whatever they became; these are not
+# counted if they may have become fewer (cf. changed_glyphs). A lookup
+# attaching marks sees back to the nearest glyph a mark can be attached
+# to, which is then the only kind of glyph kept. The glyphs that start a
+# rule are the triggers of the lookup. A lookup attaching marks that is
+# applied by rules of the lookup, at their triggers, keeps other glyphs,
+# so it makes a part of the reach of its own; the reach of each part is to
+# be kept to (cf. parts). The inputs are how many kept glyphs ahead of a
+# trigger a rule may change, through the lookups it applies as well.
+class LookupReach:
+	def __init__(self, lookup, font, triggers=None):
+		self.font = font
+		self.triggers = self.first_glyphs(lookup) if triggers is None else triggers
+		self.reverse = isinstance(lookup, GSUB_Lookup) and lookup.reverse
+		self.masks = []
+		self.targets = None
+		self.attaching = []
+		self.nested_reaches = {}
+		self.onward = []
+		self.backward = []
+		self.inputs = 0
+		self.changed = None
+		self.fewer = True
+		self.back, self.ahead = self.add(lookup, font, set(), False)
+		self.table = None
+		self.trigger_table = None
+		self.parts = [self]
+		for nested_lookup in self.attaching:
+			self.parts += LookupReach(nested_lookup, font, self.triggers).parts
+
+	# The glyphs at which a rule of the lookup can match: a contextual
+	# positioning rule matches its input from the glyph it starts at, unless
+	# the lookup skips that glyph.
+	def first_glyphs(self, lookup):
+		if isinstance(lookup, GSUB_Lookup) or all(not isinstance(rule, ChainPos) for rule in lookup.positionings):
+			return lookup.triggers
+		triggers = set()
+		for rule in lookup.positionings:
+			if isinstance(rule, ChainPos) and rule.input is not None and len(rule.input_right_sets) > 0:
+				triggers.update(id for id in rule.first_ids() if id in rule.input_right_sets[0] or not lookup.mask[id])
+			else:
+				triggers.update(rule.first_ids())
+		return frozenset(triggers)
+
+	def add(self, lookup, font, seen, nested):
+		seen.add(id(lookup))
+		if isinstance(lookup, GSUB_Lookup):
+			rules = lookup.substitutions
+		else:
+			rules = lookup.positionings
+		# The sets of glyph IDs each rule matches ahead, and back (nearest
+		# first), with None for any glyph, and the lookups it applies at
+		# which input glyph
+		sequences = []
+		for rule in rules:
+			if isinstance(rule, (MarkBaseAttachment, MarkMarkAttachment)):
+				if nested:
+					if all(attaching is not lookup for attaching in self.attaching):
+						self.attaching.append(lookup)
+				else:
+					targets = rule.base_glyphs if isinstance(rule, MarkBaseAttachment) else \
+						rule.mark2_to_index.keys()
+					self.targets = set(targets) if self.targets is None else self.targets.union(targets)
+					sequences.append(([], [None], [], 0))
+				continue
+			if isinstance(rule, LigSubstitution):
+				sequences.append((list(rule.component_sets), [], [], len(rule.component_sets)))
+			elif isinstance(rule, ChainSubstitution3):
+				sequences.append((rule.input_sets[1:] + rule.right_sets, rule.left_sets[::-1], \
+					[(pos, font.GSUB_lookups.get(index)) for pos, index in rule.refs], len(rule.input_sets) - 1))
+			elif isinstance(rule, ReverseSubstitution):
+				sequences.append((list(rule.right_sets), rule.left_sets[::-1], [], 0))
+			elif isinstance(rule, ChainPos):
+				sequences.append((rule.input_right_sets[1:], rule.left_sets[::-1], \
+					[(0, font.GPOS_lookups.get(rule.recur()))] if rule.recur() is not None else [], \
+					len(rule.input) - 1 if rule.input is not None else 0))
+			else:
+				sequences.append(([None] * (rule.length() - 1), [], [], rule.length() - 1))
+		# A lookup applied at an input glyph sees from there, whatever the
+		# glyphs, and may change glyphs as far as it sees ahead
+		inputs = 0
+		for onward, backward, applied, changes in sequences:
+			for pos, nested_lookup in applied:
+				if nested_lookup is None:
+					continue
+				if id(nested_lookup) not in seen:
+					self.nested_reaches[id(nested_lookup)] = self.add(nested_lookup, font, seen, True)
+				nested_back, nested_ahead = self.nested_reaches.get(id(nested_lookup), (0, 0))
+				onward += [None] * (pos + nested_ahead - len(onward))
+				backward += [None] * (nested_back - pos - len(backward))
+				changes = max(changes, pos + nested_ahead)
+			inputs = max(inputs, changes)
+		back = max([len(backward) for onward, backward, applied, changes in sequences] + [0])
+		ahead = max([len(onward) for onward, backward, applied, changes in sequences] + [0])
+		if (not nested or back > 0 or ahead > 0) and all(mask is not lookup.mask for mask in self.masks):
+			self.masks.append(lookup.mask)
+		if not nested:
+			single = not self.reverse and len(self.masks) == 1
+			self.inputs = inputs
+			self.onward = matched_sets([onward for onward, backward, applied, changes in sequences], ahead) \
+				if single else [None] * ahead
+			self.backward = matched_sets([backward for onward, backward, applied, changes in sequences], back) \
+				if single and not isinstance(lookup, GSUB_Lookup) else [None] * back
+			if single and isinstance(lookup, GSUB_Lookup) and back > 0:
+				matched = [ids for onward, backward, applied, changes in sequences for ids in backward]
+				changed = self.changed_glyphs(lookup, font)
+				if changed is not None and all(ids is not None for ids in matched):
+					self.backward = [np.array(sorted(frozenset().union(*matched)), dtype=np.int64)] * back
+					self.changed = changed
+		return back, ahead
+
+	# The glyphs a substitution lookup may change, as a sorted array of glyph
+	# IDs: the input of its rules; or None if a lookup its rules apply sees
+	# other glyphs. Sets fewer, whether the glyphs it changes may become
+	# fewer kept glyphs: through ligatures, or outputs the mask skips.
+	def changed_glyphs(self, lookup, font):
+		changed = set(self.triggers)
+		outputs = []
+		self.fewer = False
+		for rule in lookup.substitutions:
+			if isinstance(rule, LigSubstitution):
+				changed.update(*rule.component_sets)
+				self.fewer = True
+			elif isinstance(rule, ChainSubstitution3):
+				changed.update(*rule.input_sets[1:])
+				for pos, index in rule.refs:
+					nested_lookup = font.GSUB_lookups.get(index)
+					if nested_lookup is not None and self.nested_reaches.get(id(nested_lookup)) != (0, 0):
+						return None
+					if nested_lookup is not None:
+						outputs += [output for nested_rule in nested_lookup.substitutions \
+							for output in substitution_outputs(nested_rule)]
+			else:
+				outputs += substitution_outputs(rule)
+		mask = lookup.mask
+		self.fewer = self.fewer or any(output is None or output >= len(mask) or not mask[output] \
+			for output in outputs)
+		return np.array(sorted(changed), dtype=np.int64)
+
+	# Whether each glyph ID is kept, as an array, made again when glyphs are
+	# numbered
+	def kept_table(self):
+		size = len(self.font.glyph_names)
+		if self.table is None or len(self.table) != size:
+			masks = [np.frombuffer(bytes(mask[:size]), dtype=np.uint8).astype(np.bool_) for mask in self.masks]
+			table = np.logical_and.reduce(masks)
+			if self.targets is not None:
+				targets = np.zeros(size, dtype=np.bool_)
+				targets[[id for id in self.targets if id < size]] = True
+				table &= targets
+			self.table = table
+		return self.table
+
+	# Whether each of an array of glyph IDs is kept
+	def kept(self, glyphs):
+		return self.kept_table()[np.frombuffer(glyphs, dtype=np.uint16)]
+
+	# Whether each of an array of glyph IDs is a trigger
+	def triggered(self, glyphs):
+		size = len(self.font.glyph_names)
+		if self.trigger_table is None or len(self.trigger_table) != size:
+			self.trigger_table = np.zeros(size, dtype=np.bool_)
+			self.trigger_table[[id for id in self.triggers if id < size]] = True
+		return self.trigger_table[np.frombuffer(glyphs, dtype=np.uint16)]
+
+# The glyphs a substitution rule that sees no other glyphs gives, as glyph
+# IDs, with None if there may be none.
+def substitution_outputs(rule):
+	if isinstance(rule, SingleSubstitution1):
+		return [rule.output_id]
+	if isinstance(rule, MultSubstitution):
+		return rule.output_ids if len(rule.output_ids) > 0 else [None]
+	return [None]
+
+# For each distance up to length, the glyphs there that some of the
+# sequences of sets of glyph IDs match, as a sorted array, or None for any
+# (cf. LookupReach)
+def matched_sets(sequences, length):
+	matched = []
+	for k in range(length):
+		sets = [sequence[k] for sequence in sequences if len(sequence) > k]
+		if any(ids is None for ids in sets):
+			matched.append(None)
+		else:
+			matched.append(np.array(sorted(frozenset().union(*sets)), dtype=np.int64))
+	return matched
+
+# Dict that counts its changes in version, so that what is derived from it
+# can be made again when it changes (cf. Font.compile). The version starts
+# from that of the class, as unpickling sets the items before the version.
+class VersionedDict(dict):
+	version = 0
+
+	def changed(self):
+		self.version += 1
+
+	def __setitem__(self, key, value):
+		super().__setitem__(key, value)
+		self.changed()
+
+	def __delitem__(self, key):
+		super().__delitem__(key)
+		self.changed()
+
+	def setdefault(self, key, default=None):
+		if key not in self:
+			self.changed()
+		return super().setdefault(key, default)
+
+	def pop(self, *args):
+		self.changed()
+		return super().pop(*args)
+
+	def popitem(self):
+		self.changed()
+		return super().popitem()
+
+	def update(self, *args, **kwargs):
+		super().update(*args, **kwargs)
+		self.changed()
+
+	def clear(self):
+		super().clear()
+		self.changed()
+
 # Glyph classes (cf. glyph_to_class)
 BASE_GLYPH = 1
 LIGATURE_GLYPH = 2
@@ -596,7 +1382,10 @@ class Font:
 		self.vs_to_name = {}
 
 		self.glyphs = []
+		# Advance widths by name, as a versioned dict (cf. advance_array)
 		self.width = {}
+		self.advances = None
+		self.advances_key = None
 		self.lsb = {}
 		self.height = {}
 		self.tsb = {}
@@ -615,6 +1404,29 @@ class Font:
 		self.mark_to_class = {}
 		self.index_to_glyphs = {}
 
+		# Glyph ID 0 is UNKNOWN_GLYPH, which all input names the font does not
+		# know get (cf. names_to_ids). The IDs after it follow the glyph order;
+		# names outside it that rules use are numbered after it as they are met.
+		self.glyph_ids = {}
+		self.glyph_names = []
+		self.glyph_classes = bytearray()
+		self.n_glyphs_numbered = 0
+		# For each filter key, whether each glyph ID is kept by lookups with that key
+		self.filter_masks = {}
+		self.unknown_id = self.glyph_id(UNKNOWN_GLYPH)
+		# The versions of the class dicts that glyph_classes and filter_masks
+		# were made for
+		self.classes_key = self.class_dicts_key()
+		# Incremented whenever compile finds the glyphs, lookups or features
+		# changed, which invalidates the render cache, if any
+		self.generation = 0
+		self.render_cache = None
+		# Observer of the shaping (cf. ttxhooks), if any
+		self.hooks = None
+		# Shape plans by script and suppressed features, for plans_generation
+		self.plans = {}
+		self.plans_generation = 0
+
 		self.GSUB_features = []
 		self.GSUB_lookup_list = []
 		self.GSUB_lookups = {}
@@ -624,6 +1436,50 @@ class Font:
 		self.GPOS_lookups = {}
 		self.GPOS_lookup_index_to_feature = {}
 
+	# The glyph classes, mark classes and mark filtering sets, as versioned
+	# dicts. A dict assigned anew goes on from the version of the old one.
+	@property
+	def glyph_to_class(self):
+		return self._glyph_to_class
+
+	@glyph_to_class.setter
+	def glyph_to_class(self, classes):
+		self._glyph_to_class = self.versioned(classes, getattr(self, '_glyph_to_class', None))
+
+	@property
+	def mark_to_class(self):
+		return self._mark_to_class
+
+	@mark_to_class.setter
+	def mark_to_class(self, classes):
+		self._mark_to_class = self.versioned(classes, getattr(self, '_mark_to_class', None))
+
+	@property
+	def index_to_glyphs(self):
+		return self._index_to_glyphs
+
+	@index_to_glyphs.setter
+	def index_to_glyphs(self, sets):
+		self._index_to_glyphs = self.versioned(sets, getattr(self, '_index_to_glyphs', None))
+
+	@property
+	def width(self):
+		return self._width
+
+	@width.setter
+	def width(self, widths):
+		self._width = self.versioned(widths, getattr(self, '_width', None))
+
+	@staticmethod
+	def versioned(d, old):
+		d = VersionedDict(d)
+		if old is not None:
+			d.version = old.version + 1
+		return d
+
+	def class_dicts_key(self):
+		return (self.glyph_to_class.version, self.mark_to_class.version, self.index_to_glyphs.version)
+
 	def set_property(self, section, prop, val):
 		self.properties[section][prop] = str(val)
 
@@ -679,6 +1535,7 @@ class Font:
 		self.extra_names.append(name)
 
 	def add_GSUB_feature(self, feature):
+		self.generation += 1
 		self.GSUB_features.append(feature)
 		for lookup_index in feature.lookup_indexes:
 			self.GSUB_lookup_index_to_feature[lookup_index] = feature
@@ -688,6 +1545,7 @@ class Font:
 		self.GSUB_lookups[index] = lookup
 
 	def add_GPOS_feature(self, feature):
+		self.generation += 1
 		self.GPOS_features.append(feature)
 		for lookup_index in feature.lookup_indexes:
 			self.GPOS_lookup_index_to_feature[lookup_index] = feature
@@ -702,64 +1560,336 @@ class Font:
 	def new_GSUB_lookup(self, t, feat=None):
 		# use integer index for consistency with readers/writers
 		index = len(self.GSUB_lookup_list)
+		self.generation += 1
 		lookup = GSUB_Lookup(index, t)
 		self.add_GSUB_lookup(index, lookup)
 		if feat is not None:
 			feat.add_lookup_index(index)
 		return lookup
 
-	def apply(self, tokens, suppressed=[]):
-		applications = []
+	def glyph_id(self, name):
+		id = self.glyph_ids.get(name)
+		if id is None:
+			id = len(self.glyph_names)
+			self.glyph_ids[name] = id
+			self.glyph_names.append(name)
+			self.glyph_classes.append(self.glyph_to_class.get(name, 0))
+			for key, mask in self.filter_masks.items():
+				mask.append(unfiltered(name, self, key, self.filter_glyphs(key)))
+		return id
+
+	def filter_glyphs(self, key):
+		filter_set = key[4]
+		if filter_set is not None and filter_set in self.index_to_glyphs:
+			return set(self.index_to_glyphs[filter_set])
+		return None
+
+	def filter_mask(self, lookup):
+		key = filter_key(lookup)
+		mask = self.filter_masks.get(key)
+		if mask is None:
+			filter_glyphs = self.filter_glyphs(key)
+			if key == (False, False, False, 0, None):
+				mask = bytearray(b'\x01') * len(self.glyph_names)
+			elif key[3] != 0 or filter_glyphs is not None:
+				# Only glyphs in the mark class or filtering set, and unclassified
+				# glyphs, can be kept
+				mask = bytearray(len(self.glyph_names))
+				for name in set(self.glyph_names).difference(self.glyph_to_class).union( \
+						self.mark_to_class if key[3] != 0 else filter_glyphs):
+					if name in self.glyph_ids:
+						mask[self.glyph_ids[name]] = unfiltered(name, self, key, filter_glyphs)
+			else:
+				mask = bytearray(unfiltered(name, self, key, filter_glyphs) for name in self.glyph_names)
+			self.filter_masks[key] = mask
+		return mask
+
+	# Number the glyphs, attach to each lookup the filter mask for its current
+	# flags, and index the rules of lookups that were changed. If the glyph
+	# classes, mark classes or mark filtering sets changed, the glyph classes
+	# by ID and the filter masks are made again, and the GPOS lookups, which
+	# depend on the classes, compiled again.
+	def compile(self):
+		changed = self.n_glyphs_numbered != len(self.glyphs)
+		classes_key = self.class_dicts_key()
+		if self.classes_key != classes_key:
+			self.glyph_classes = bytearray(self.glyph_to_class.get(name, 0) for name in self.glyph_names)
+			self.filter_masks = {}
+			for lookup in self.GPOS_lookup_list:
+				lookup.compiled = False
+			self.classes_key = classes_key
+			changed = True
+		for name in self.glyphs[self.n_glyphs_numbered:]:
+			self.glyph_id(name)
+		self.n_glyphs_numbered = len(self.glyphs)
+		for lookup in self.GSUB_lookup_list + self.GPOS_lookup_list:
+			mask = self.filter_mask(lookup)
+			if lookup.mask is not mask:
+				lookup.mask = mask
+				changed = True
 		for lookup in self.GSUB_lookup_list:
-			if lookup.index in self.GSUB_lookup_index_to_feature:
-				tag = self.GSUB_lookup_index_to_feature[lookup.index].tag
-				if tag not in suppressed:
-					tokens, applications_lookup = lookup.apply(tokens, self)
-					for a in applications_lookup:
-						a['feature'] = tag
-						applications.append(a)
-		positionings = [{} for t in tokens]
+			if lookup.first_to_subs is None:
+				lookup.compile(self)
+				changed = True
 		for lookup in self.GPOS_lookup_list:
-			if lookup.index in self.GPOS_lookup_index_to_feature:
-				tag = self.GPOS_lookup_index_to_feature[lookup.index].tag
-				if tag not in suppressed:
-					positionings, applications_lookup = lookup.apply(tokens, positionings, self)
-					for a in applications_lookup:
-						a['feature'] = tag
-						applications.append(a)
-		return tokens, positionings, applications
-
+			if not lookup.compiled:
+				lookup.compile(self)
+				changed = True
+		if changed:
+			self.generation += 1
+
+	# The plan for the script of the font, made once per generation.
+	def shape_plan(self, suppressed=[]):
+		if self.plans_generation != self.generation:
+			self.plans = {}
+			self.plans_generation = self.generation
+		key = (self.script, frozenset(suppressed))
+		plan = self.plans.get(key)
+		if plan is None:
+			plan = ShapePlan(self, self.script, key[1])
+			self.plans[key] = plan
+		return plan
+
+	# What the results of shaping depend on, apart from the input.
+	def fingerprint(self):
+		return (id(self), self.generation, self.width.version)
+
+	# Keep the results of render in a cache of the given size, or none if
+	# size is None.
+	def set_render_cache(self, size=256, eviction='lru'):
+		self.render_cache = RenderCache(size, eviction) if size is not None else None
+		self.render_cache_generation = self.generation
+
+	# The IDs of glyph names, and the names mapped to unknown_id, in order.
+	# Unknown names are not numbered, so that shaping arbitrary input does
+	# not grow the font; no rule applies to unknown_id and no lookup skips
+	# it, so it is never changed, removed or reordered, and ids_to_names can
+	# put the names back in the same order.
+	def names_to_ids(self, names):
+		glyph_ids = self.glyph_ids
+		unknown_id = self.unknown_id
+		ids = []
+		unknown = []
+		for name in names:
+			id = glyph_ids.get(name, unknown_id)
+			if id == unknown_id:
+				unknown.append(name)
+			ids.append(id)
+		return ids, unknown
+
+	def ids_to_names(self, ids, unknown=()):
+		glyph_names = self.glyph_names
+		unknown_id = self.unknown_id
+		names = []
+		k = 0
+		for id in ids:
+			if id == unknown_id and k < len(unknown):
+				names.append(unknown[k])
+				k += 1
+			else:
+				names.append(glyph_names[id])
+		return names
+
+	# Shapes glyph names. Inside, the glyphs are IDs; applications give the
+	# buffer as it was in names.
+	# With clusters, the clusters of the glyphs (cf. GlyphBuffer) are
+	# returned as well.
+	# With a profiler (cf. ttxprofile), that is the hooks during the shaping.
+	# With stages (cf. ttxwindow), the state after each lookup is added to it.
+	def apply(self, tokens, suppressed=[], trace=TRACE_FULL, clusters=False, profiler=None, stages=None):
+		self.compile()
+		ids, unknown = self.names_to_ids(tokens)
+		names = lambda glyphs: self.ids_to_names(glyphs, unknown)
+		if profiler is not None:
+			hooks = self.hooks
+			self.hooks = profiler
+			try:
+				result = self.apply_ids(ids, suppressed, trace=trace, names=names, \
+					clusters=clusters, stages=stages)
+			finally:
+				self.hooks = hooks
+		else:
+			result = self.apply_ids(ids, suppressed, trace=trace, names=names, \
+				clusters=clusters, stages=stages)
+		return (names(result[0]),) + result[1:]
+
+	# Shapes many sequences of glyph names, or strings, over worker processes
+	# (cf. ttxbatch). Each result is that of apply, or the exception raised
+	# for that sequence.
+	def apply_many(self, sequences, suppressed=[], trace=TRACE_OFF, workers=None, \
+			chunksize=64, mp_context=None):
+		return shape_many(self, sequences, suppressed, trace, False, workers, chunksize, mp_context)
+
+	# The applications are, depending on trace, none, a dict from feature
+	# and lookup index to the number of applications, or a list of
+	# Application records. With names, a function from glyph IDs to names,
+	# the applications give the buffer in names.
+	def apply_ids(self, tokens, suppressed=[], trace=TRACE_FULL, names=None, clusters=False, stages=None):
+		history = None
+		if trace == TRACE_FULL:
+			history = History(tokens, names)
+		tokens = GlyphBuffer(tokens, history)
+		applications = {} if trace == TRACE_COUNTS else []
+		plan = self.shape_plan(suppressed)
+		hooks = self.hooks
+		if stages is not None:
+			stages.add_glyphs(tokens)
+		for lookup, tag in plan.GSUB_lookups:
+			if hooks is not None:
+				hooks.lookup_start(lookup, tag, tokens)
+			applications_lookup = lookup.apply(tokens, self)
+			if hooks is not None:
+				hooks.lookup_end(lookup, tag, tokens, applications_lookup)
+			self.add_applications(applications, applications_lookup, tag, trace)
+			if stages is not None:
+				stages.add_glyphs(tokens)
+		positionings = PositionBuffer(len(tokens))
+		for lookup, tag in plan.GPOS_lookups:
+			if hooks is not None:
+				hooks.lookup_start(lookup, tag, tokens)
+			positionings, applications_lookup = lookup.apply(tokens, positionings, self)
+			if hooks is not None:
+				hooks.lookup_end(lookup, tag, tokens, applications_lookup)
+			self.add_applications(applications, applications_lookup, tag, trace)
+			if stages is not None:
+				stages.add_positionings(positionings)
+		if clusters:
+			return tokens.snapshot(), positionings, applications, list(tokens.clusters())
+		return tokens.snapshot(), positionings, applications
+
+	def add_applications(self, applications, applications_lookup, tag, trace):
+		if trace == TRACE_FULL:
+			for a in applications_lookup:
+				a.feature = tag
+				applications.append(a)
+		elif trace == TRACE_COUNTS:
+			for a in applications_lookup:
+				applications[(tag, a.index)] = applications.get((tag, a.index), 0) + 1
+
+	# The advance width of each glyph, indexed by glyph ID, with 0 after the
+	# last for glyphs without ID. Rebuilt when glyphs are added or widths
+	# change.
+	def advance_array(self):
+		key = (self.width.version, len(self.glyph_names))
+		if self.advances_key != key:
+			self.advances = np.array([self.width.get(name, 0) for name in self.glyph_names] + [0], \
+				dtype=np.int64)
+			self.advances_key = key
+		return self.advances
+
+	# The place of each glyph: the first at (0, 0), each next one moved by
+	# its offsets and its width (plus advance adjustment) from the previous
+	# one. Positionings are a PositionBuffer or a list of dicts.
 	def shape(self, tokens, positionings):
-		places = [(0, 0)]  # Start from the first glyph at position (0, 0)
-		x = 0
-		y = 0
-
-		for i, tok in enumerate(tokens[1:]):
-			pos = positionings[i+1]
-
-			dx = pos.get('XCoordinate', 0)
-			dy = pos.get('YCoordinate', 0)
-
-			# Print debug info for each glyph
-			print(f"Glyph: {tok}, dx: {dx}, dy: {dy}, Current position: ({x}, {y})")
-
-			x += dx
-			y += dy
-
-			# Optionally: Adjust x based on the width of the current glyph
-			glyph_width = self.width.get(tok, 0)
-			print(f"Glyph width for {tok}: {glyph_width}")
-
-			x += glyph_width  # Adjust X based on glyph width
-			places.append((x, y))
+		n = len(tokens)
+		if n == 0:
+			return [(0, 0)]
+		if isinstance(positionings, PositionBuffer):
+			dxs = positionings.x().astype(np.int64)
+			dys = positionings.y().astype(np.int64)
+			advances = positionings.x_advance().astype(np.int64)
+		else:
+			dxs = np.fromiter((p.get('XCoordinate', 0) for p in positionings), dtype=np.int64, count=n)
+			dys = np.fromiter((p.get('YCoordinate', 0) for p in positionings), dtype=np.int64, count=n)
+			advances = np.fromiter((p.get('XAdvance', 0) for p in positionings), dtype=np.int64, count=n)
+		ids = np.fromiter((self.glyph_ids.get(tok, -1) for tok in tokens), dtype=np.int64, count=n)
+		widths = self.advance_array()[ids]
+		for i in np.flatnonzero(ids < 0):
+			widths[i] = self.width.get(tokens[i], 0)
+		steps_x = dxs + widths + advances
+		steps_x[0] = 0
+		steps_y = dys.copy()
+		steps_y[0] = 0
+		places = list(zip(np.cumsum(steps_x).tolist(), np.cumsum(steps_y).tolist()))
+
+		hooks = self.hooks
+		if hooks is not None:
+			for i, tok in enumerate(tokens):
+				hooks.glyph_placed(tok, int(dxs[i]), int(dys[i]), places[i])
 
 		return places
 
-
-
-	def render(self, tokens, suppressed=[]):
-		tokens, positionings, applications = self.apply(tokens, suppressed=suppressed)
-		return tokens, positionings, applications, self.shape(tokens, positionings)
+	# Shapes a stream of glyph names, holding at most max_window of them at
+	# a time. Yields for each shaped glyph its name, positioning and place
+	# (as by shape, with the places running on over the whole stream).
+	# Tokens are read chunk at a time, or as many as the window holds if
+	# more, and the window is shaped once for each read, so that each token
+	# is shaped about twice at most. The glyphs from the tokens before its
+	# safe end (cf. ttxwindow) are yielded, as no tokens that follow can
+	# change them, and the window is cut at the last token before those
+	# where no rule matches glyphs on both sides, whatever follows (cf.
+	# stream_crossings). If more than half the window would then be kept,
+	# it is cut within the last half where the fewest rules match glyphs on
+	# both sides, and the glyphs up to there are yielded: these, and those
+	# that follow, may then differ from those of shaping the whole.
+	def shape_stream(self, tokens, suppressed=[], chunk=256, max_window=4096):
+		self.compile()
+		plan = self.shape_plan(suppressed)
+		GSUB_reaches, GPOS_reaches = plan.reaches(self)
+		kept = max(1, max_window // 2)
+		tokens = iter(tokens)
+		window = []
+		# The number of tokens at the start of the window whose glyphs have
+		# been yielded already, as context for the others
+		done = 0
+		place = None
+		while True:
+			n_read = max(1, min(max(chunk, len(window)), max_window - len(window)))
+			n_window = len(window)
+			window.extend(islice(tokens, n_read))
+			at_end = len(window) - n_window < n_read
+			stages = Stages()
+			out_tokens, positionings, applications, clusters = self.apply(window, suppressed=suppressed, \
+				trace=TRACE_OFF, clusters=True, stages=stages)
+			if at_end:
+				safe = start = len(window)
+			else:
+				safe = max(done, safe_end(stages, GSUB_reaches, GPOS_reaches))
+				crossings = stream_crossings(stages, safe, GSUB_reaches, GPOS_reaches)
+				start = int(np.flatnonzero(crossings[:safe + 1] == 0)[-1])
+				least = len(window) - kept
+				if start < least:
+					start = least + int(np.argmin(crossings[least:]))
+					safe = max(safe, start)
+			for i in range(bisect_left(clusters, done), bisect_left(clusters, safe)):
+				dx = positionings[i].get('XCoordinate', 0)
+				dy = positionings[i].get('YCoordinate', 0)
+				if place is None:
+					place = (0, 0)
+				else:
+					place = (place[0] + dx + self.width.get(out_tokens[i], 0) + \
+						positionings[i].get('XAdvance', 0), place[1] + dy)
+				if self.hooks is not None:
+					self.hooks.glyph_placed(out_tokens[i], dx, dy, place)
+				yield out_tokens[i], positionings[i], place
+			if at_end:
+				return
+			window = window[start:]
+			done = safe - start
+
+	# With clusters, the clusters are returned after the places. The
+	# positionings are a list of dicts. Results are copies, whether from the
+	# cache or not, so that the caller may change them.
+	def render(self, tokens, suppressed=[], trace=TRACE_FULL, clusters=False):
+		if self.render_cache is None:
+			result = self.render_uncached(tokens, suppressed, trace, clusters)
+		else:
+			self.compile()
+			if self.render_cache_generation != self.generation:
+				self.render_cache.clear()
+				self.render_cache_generation = self.generation
+			key = (self.fingerprint(), tuple(tokens), frozenset(suppressed), trace, clusters)
+			result = self.render_cache.get(key)
+			if result is None:
+				result = self.render_uncached(tokens, suppressed, trace, clusters)
+				self.render_cache.put(key, result)
+		tokens, positionings, applications, places = result[:4]
+		return (list(tokens), list(positionings), copy_applications(applications), list(places)) + \
+			tuple(list(c) for c in result[4:])
+
+	def render_uncached(self, tokens, suppressed, trace, clusters):
+		result = self.apply(tokens, suppressed=suppressed, trace=trace, clusters=clusters)
+		return result[:3] + (self.shape(result[0], result[1]),) + result[3:]
 
 	def __str__(self):
 		s = ''
@@ -790,26 +1920,101 @@ class Simulator:
 	def __init__(self, font):
 		self.font = font
 		self.suppressed = []
+		self.trace = TRACE_FULL
 		self.in_tokens = []
 		self.tokens = []
 		self.positionings = []
-		self.applications = []
+		self.traced = []
 		self.places = []
+		self.clusters = []
+		# The state after each lookup (cf. ttxwindow), made when first needed
+		# by edit
+		self.stages = None
+
+	# The applications, as by Font.render with the trace of the simulator.
+	# After an edit, which reshapes without tracing, they are made by a
+	# full render when first asked for.
+	@property
+	def applications(self):
+		if self.traced is None:
+			self.traced = self.font.render(self.in_tokens, suppressed=self.suppressed, trace=self.trace)[2]
+		return self.traced
+
+	@applications.setter
+	def applications(self, applications):
+		self.traced = applications
 
 	def set_tokens(self, tokens):
 		self.in_tokens = tokens
-		self.tokens, self.positionings, self.applications, self.places = \
-			self.font.render(tokens, suppressed=self.suppressed)
+		self.tokens, self.positionings, self.applications, self.places, self.clusters = \
+			self.font.render(tokens, suppressed=self.suppressed, trace=self.trace, clusters=True)
+		self.stages = None
+
+	# As set_tokens, keeping the state after each lookup.
+	def set_tokens_stages(self, tokens):
+		self.in_tokens = tokens
+		self.stages = Stages()
+		self.tokens, positionings, applications, self.clusters = self.font.apply(tokens, \
+			suppressed=self.suppressed, trace=TRACE_OFF, clusters=True, stages=self.stages)
+		self.positionings = list(positionings)
+		self.applications = applications if self.trace == TRACE_OFF else None
+		self.places = self.font.shape(self.tokens, self.positionings)
+
+	# Replaces the input tokens from start to end by tokens, and reshapes
+	# lookup by lookup only the glyphs that differ from before, with those
+	# the rules of the lookup match around them (cf. ttxwindow.reshape). The
+	# first edit shapes in full, keeping the state after each lookup.
+	def edit(self, start, end, tokens):
+		tokens = list(tokens)
+		in_tokens = self.in_tokens[:start] + tokens + self.in_tokens[end:]
+		if self.stages is None:
+			self.set_tokens_stages(in_tokens)
+			return
+		font = self.font
+		font.compile()
+		plan = font.shape_plan(self.suppressed)
+		GSUB_reaches, GPOS_reaches = plan.reaches(font)
+		ids, unknown = font.names_to_ids(in_tokens)
+		self.stages = reshape(font, plan, self.stages, ids, start, end, GSUB_reaches, GPOS_reaches)
+		self.in_tokens = in_tokens
+		glyphs, clusters = self.stages.glyphs[-1]
+		positionings = PositionBuffer(len(glyphs))
+		if len(self.stages.positionings) > 0:
+			positionings.values, positionings.given = self.stages.positionings[-1]
+		self.tokens = font.ids_to_names(glyphs, unknown)
+		self.positionings = list(positionings)
+		self.clusters = list(clusters)
+		self.places = font.shape(self.tokens, self.positionings)
+		self.applications = [] if self.trace == TRACE_OFF else None
+
+	def insert(self, pos, tokens):
+		self.edit(pos, pos, tokens)
+
+	def delete(self, start, end):
+		self.edit(start, end, [])
 
 	def set_string(self, string):
 		self.in_tokens = self.font.string_to_tokens(string)
 		self.set_tokens(self.in_tokens)
 
+	# Renders many sequences of glyph names, or strings, over worker
+	# processes. Each result is that of Font.render, or the exception raised
+	# for that sequence. The state of the simulator is not changed. As with
+	# Font.apply_many, no applications are traced unless asked for, as full
+	# traces are large to send back from the workers.
+	def shape_batch(self, sequences, trace=TRACE_OFF, workers=None, chunksize=64, mp_context=None):
+		return shape_many(self.font, sequences, self.suppressed, trace, True, \
+			workers, chunksize, mp_context)
+
 	def in_tokens_str(self):
 		return ' '.join(self.in_tokens)
 		
 	def steps_str(self):
 		s = ''
+		if self.trace == TRACE_COUNTS:
+			for (feature, index), count in self.applications.items():
+				s += 'feature: {}, lookup: {}, applications: {}'.format(feature, index, count) + '\n'
+			return s
 		for a in self.applications:
 			s += 'feature: {}, lookup: {}, pos: {}'.format(a['feature'], a['index'], \
 				','.join([str(p) for p in a['posses']])) + '\n'
@@ -0,0 +1,48 @@
+# Observer of the reading and shaping of a font. The methods are called at
+# the points they are named after, and do nothing here; debugging, logging
+# or metrics come from a subclass that overrides some of them. A font
+# without hooks (font.hooks is None) skips the calls altogether.
+class Hooks:
+	# Whether the hooks observe the positions and rules within a pass; if
+	# not, lookups may apply at all positions at once, without the calls
+	per_position = True
+
+	# Before and after a pass of a GSUB or GPOS lookup, for the feature with tag
+	def lookup_start(self, lookup, tag, tokens):
+		pass
+
+	def lookup_end(self, lookup, tag, tokens, applications):
+		pass
+
+	# The lookup is attempted at pos, in a pass or by recursion
+	def position_visited(self, lookup, pos):
+		pass
+
+	# Whether a rule applies at pos is tested; rule is None if the rules are
+	# matched all at once (cf. LigatureTrie, ChainAutomaton)
+	def rule_tried(self, lookup, rule, pos):
+		pass
+
+	# A rule of the lookup applies at pos
+	def rule_matched(self, lookup, rule, pos):
+		pass
+
+	# A rule of the lookup applies the lookup recur_lookup at pos
+	def recursion(self, lookup, recur_lookup, pos):
+		pass
+
+	# A glyph is placed by Font.shape, with its adjustment and its place
+	def glyph_placed(self, glyph, dx, dy, place):
+		pass
+
+	# An element of the TTX file that the reader does not know, within where
+	def unexpected(self, where, elem):
+		pass
+
+# Prints what shaping used to print, and the unexpected elements.
+class PrintHooks(Hooks):
+	def glyph_placed(self, glyph, dx, dy, place):
+		print(f"Glyph: {glyph}, dx: {dx}, dy: {dy}, position: {place}")
+
+	def unexpected(self, where, elem):
+		print('Unexpected in ' + where, elem)
@@ -0,0 +1,113 @@
+import json
+import time
+
+from ttxhooks import Hooks
+
+# Counters per lookup, gathered as hooks (cf. Font.apply with profiler).
+class LookupStats:
+	def __init__(self, table, lookup):
+		self.table = table
+		self.lookup = lookup
+		self.tags = set()
+		self.time = 0.0
+		self.passes = 0
+		self.positions = 0
+		self.tries = 0
+		self.matches = 0
+		self.recursions = 0
+		# Number of matches by rule
+		self.hits = {}
+
+	def rule_number(self, rule):
+		rules = self.lookup.substitutions if self.table == 'GSUB' else self.lookup.positionings
+		for i, r in enumerate(rules):
+			if r is rule:
+				return i
+		return -1
+
+	def to_dict(self, total_time):
+		rules = [{'rule': self.rule_number(rule), 'text': str(rule), 'hits': hits} \
+			for rule, hits in sorted(self.hits.items(), key=lambda item: -item[1])]
+		return {'table': self.table, 'index': self.lookup.index, 'type': self.lookup.typ, \
+			'features': sorted(self.tags), 'time': self.time, \
+			'share': self.time / total_time if total_time > 0 else 0.0, \
+			'passes': self.passes, 'positions': self.positions, 'tries': self.tries, \
+			'matches': self.matches, 'recursions': self.recursions, 'rules': rules}
+
+# Wall time of the lookup passes, and the positions visited, rules tried,
+# matches and recursions of each lookup, plus the matches of each rule.
+# The time of a pass includes that of the lookups it recurs to.
+# Observing positions keeps lookups from applying at all positions at once
+# (cf. GSUB_Lookup.apply, GPOS_Lookup.apply), so the times are those of
+# the slower path; without per_position, only the passes and their times
+# are recorded, as shaped without a profiler.
+class LookupProfiler(Hooks):
+	def __init__(self, per_position=True):
+		self.stats = {}
+		self.started = None
+		self.per_position = per_position
+
+	def lookup_stats(self, lookup):
+		table = type(lookup).__name__[:4]
+		stats = self.stats.get((table, lookup.index))
+		if stats is None:
+			stats = LookupStats(table, lookup)
+			self.stats[(table, lookup.index)] = stats
+		return stats
+
+	def lookup_start(self, lookup, tag, tokens):
+		self.started = time.perf_counter()
+
+	def lookup_end(self, lookup, tag, tokens, applications):
+		stats = self.lookup_stats(lookup)
+		stats.time += time.perf_counter() - self.started
+		stats.passes += 1
+		stats.tags.add(tag)
+
+	def position_visited(self, lookup, pos):
+		if not self.per_position:
+			return
+		self.lookup_stats(lookup).positions += 1
+
+	def rule_tried(self, lookup, rule, pos):
+		if not self.per_position:
+			return
+		self.lookup_stats(lookup).tries += 1
+
+	def rule_matched(self, lookup, rule, pos):
+		if not self.per_position:
+			return
+		stats = self.lookup_stats(lookup)
+		stats.matches += 1
+		stats.hits[rule] = stats.hits.get(rule, 0) + 1
+
+	def recursion(self, lookup, recur_lookup, pos):
+		if not self.per_position:
+			return
+		self.lookup_stats(lookup).recursions += 1
+
+	# The counters of each lookup as a dict, most time first.
+	def report(self):
+		total_time = sum(stats.time for stats in self.stats.values())
+		return [stats.to_dict(total_time) for stats in \
+			sorted(self.stats.values(), key=lambda stats: -stats.time)]
+
+	def json(self, indent=None):
+		return json.dumps(self.report(), indent=indent)
+
+	# The top lookups as a table, each with its top rules, and which path
+	# the times are of.
+	def text(self, top=20, top_rules=3):
+		if self.per_position:
+			s = 'times of passes visiting each position\n'
+		else:
+			s = 'times of passes as without a profiler; positions, tries, matches and recursions not counted\n'
+		s += '{:5} {:>6} {:8} {:>9} {:>6} {:>9} {:>9} {:>8} {:>6}\n'.format( \
+			'table', 'lookup', 'type', 'time', 'share', 'positions', 'tries', 'matches', 'recur')
+		for row in self.report()[:top]:
+			s += '{:5} {:>6} {:8} {:>9.4f} {:>5.1f}% {:>9} {:>9} {:>8} {:>6}\n'.format( \
+				row['table'], row['index'], row['type'], row['time'], 100 * row['share'], \
+				row['positions'], row['tries'], row['matches'], row['recursions'])
+			for rule in row['rules'][:top_rules]:
+				s += '      rule {} x{}: {}\n'.format(rule['rule'], rule['hits'], rule['text'][:60])
+		return s
@@ -3,6 +3,10 @@ from lxml import etree
 from ttxfont import Font, Feature, \
 	GSUB_Lookup, SingleSubstitution1, MultSubstitution, LigSubstitution, ChainSubstitution3, ReverseSubstitution, \
 	GPOS_Lookup, SingleAdjustment, MarkBaseAttachment, MarkMarkAttachment, ChainPos
+# An element the reader does not know, told to the hooks of the font
+def unexpected(where, elem, font):
+	if font.hooks is not None:
+		font.hooks.unexpected(where, elem)
 
 def read_properties(doc, prop_name, font):
 	elem = doc.find(prop_name)
@@ -20,6 +24,8 @@ def read_properties(doc, prop_name, font):
 			font.properties[prop_name][sub_elem.tag] = sub_elem.get('value')
 
 def read_name(elem, font):
+	if elem is None:
+		return
 	for sub_elem in elem.findall('namerecord'):
 		nameID = sub_elem.get('nameID')
 		platformID = sub_elem.get('platformID')
@@ -59,11 +65,15 @@ def read_cmap14(elem, font):
 			font.vs_to_name[(uv, uvs)] = name
 
 def read_GlyphOrder(elem, font):
+	if elem is None:
+		return
 	for sub_elem in elem.findall('GlyphID'):
 		name = sub_elem.get('name')
 		font.glyphs.append(name)
 
 def read_hmtx(elem, font):
+	if elem is None:
+		return
 	for sub_elem in elem.findall('mtx'):
 		name = sub_elem.get('name')
 		width = int(sub_elem.get('width'))
@@ -82,6 +92,8 @@ def read_vmtx(elem, font):
 		font.tsb[name] = tsb
 
 def read_post(elem, font):
+	if elem is None:
+		return
 	for sub_elem in elem.findall('*'):
 		if sub_elem.tag is None:
 			None
@@ -94,6 +106,8 @@ def read_post(elem, font):
 			font.post[sub_elem.tag] = sub_elem.get('value')
 
 def read_glyf(elem, font):
+	if elem is None:
+		return
 	for glyph_elem in elem.findall('TTGlyph'):
 		name = glyph_elem.get('name')
 		if 'xMin' in glyph_elem.attrib:
@@ -149,18 +163,24 @@ def read_COLR(elem, font):
 			font.color_layers[glyph_name] = layers
 
 def read_GlyphClassDef(elem, font):
+	if elem is None:
+		return
 	for def_elem in elem.findall('ClassDef'):
 		glyph = def_elem.get('glyph')
 		cl = int(def_elem.get('class'))
 		font.glyph_to_class[glyph] = cl
 	
 def read_MarkAttachClassDef(elem, font):
+	if elem is None:
+		return
 	for def_elem in elem.findall('ClassDef') :
 		glyph = def_elem.get('glyph')
 		cl = int(def_elem.get('class'))
 		font.mark_to_class[glyph] = cl
 
 def read_MarkGlyphSetsDef(elem, font):
+	if elem is None:
+		return
 	for coverage_elem in elem.findall('Coverage'):
 		index = int(coverage_elem.get('index'))
 		glyph_elems = coverage_elem.findall('Glyph')
@@ -168,10 +188,7 @@ def read_MarkGlyphSetsDef(elem, font):
 		font.index_to_glyphs[index] = glyphs
 
 def read_coverage(cov):
-	tokens = []
-	for glyph_elem in cov.findall('Glyph'):
-		tokens.append(glyph_elem.get('value'))
-	return tokens
+	return [glyph_elem.get('value') for glyph_elem in cov.findall('Glyph')]
 
 def read_flag(elem, lookup):
 	flag = int(elem.get('value'))
@@ -208,7 +225,7 @@ def read_ligature_subst(lig, lookup):
 			sub = LigSubstitution(inputs, output)
 			lookup.add(sub)
 
-def read_chain_subst3(chain, lookup):
+def read_chain_subst3(chain, lookup, font):
 	# Type 6, Format 3: Replace one or more glyphs in chained context
 	lefts = []
 	inputs = []
@@ -226,11 +243,11 @@ def read_chain_subst3(chain, lookup):
 			lookup_index = int(child.find('LookupListIndex').get('value'))
 			refs.append((seq_index, lookup_index))
 		else:
-			print('Unexpected in ChainContextSubst', child)
+			unexpected('ChainContextSubst', child, font)
 	sub = ChainSubstitution3(lefts, inputs, rights, refs)
 	lookup.add(sub)
 
-def read_reverse_subst(reverse, lookup):
+def read_reverse_subst(reverse, lookup, font):
 	# type 8: Applied in reverse order, replace single glyph in chaining context
 	lefts = []
 	inputs = []
@@ -240,13 +257,13 @@ def read_reverse_subst(reverse, lookup):
 		if child.tag == 'BacktrackCoverage':
 			lefts.append(read_coverage(child))
 		elif child.tag == 'Coverage':
-			inputs.append(read_coverage(child))
+			inputs = read_coverage(child)
 		elif child.tag == 'LookAheadCoverage':
 			rights.append(read_coverage(child))
 		elif child.tag == 'Substitute':
 			outputs.append(child.get('value'))
 		else:
-			print('Unexpected in ReverseChainSingleSubst', child)
+			unexpected('ReverseChainSingleSubst', child, font)
 	sub = ReverseSubstitution(lefts, inputs, rights, outputs)
 	# GSUB_Lookup uses add() to register substitutions
 	try:
@@ -256,7 +273,7 @@ def read_reverse_subst(reverse, lookup):
 		if hasattr(lookup, 'substitutions'):
 			lookup.substitutions.append(sub)
 
-def read_single_pos(single, lookup):
+def read_single_pos(single, lookup, font):
 	# Type 1: Adjust position of a single glyph
 	form = 0
 	glyphs = []
@@ -278,14 +295,14 @@ def read_single_pos(single, lookup):
 				y = int(child.get('YPlacement'))
 				adjustments.append({'YPlacement': y})
 		else:
-			print('Unexpected in SinglePos', child)
+			unexpected('SinglePos', child, font)
 	adjs = [{'glyph': g, 'placement': a} for (g, a) in zip(glyphs, adjustments)]
 	posit = SingleAdjustment(form, adjs)
 	lookup.add_positioning(posit)
 
 
 
-def read_mark_base_pos(mark_base, lookup):
+def read_mark_base_pos(mark_base, lookup, font):
 	# Type 4: Attach a combining mark to a base glyph
 	marks = []
 	bases = []
@@ -319,11 +336,11 @@ def read_mark_base_pos(mark_base, lookup):
 					y = int(anchor_elem.find('YCoordinate').get('value'))
 					bases[index]['coordinates'][class_index] = {'x': x, 'y': y}
 		else:
-			print('Unexpected in MarkBasePos', child)
+			unexpected('MarkBasePos', child, font)
 	posit = MarkBaseAttachment(marks, bases)
 	lookup.add_positioning(posit)
 
-def read_mark_mark_pos(mark_base, lookup):
+def read_mark_mark_pos(mark_base, lookup, font):
 	# Type 6: Attach a combining mark to another mark
 	marks1 = []
 	marks2 = []
@@ -357,11 +374,11 @@ def read_mark_mark_pos(mark_base, lookup):
 					y = int(anchor_elem.find('YCoordinate').get('value'))
 					marks2[index]['coordinates'][mark_index] = {'x': x, 'y': y}
 		else:
-			print('Unexpected in MarkMarkPos', child)
+			unexpected('MarkMarkPos', child, font)
 	posit = MarkMarkAttachment(marks1, marks2)
 	lookup.add_positioning(posit)
 
-def read_chain_pos(chain, lookup):
+def read_chain_pos(chain, lookup, font):
 	# Type 8 Position one or more glyphs in chained context
 	left = []
 	input = []
@@ -377,11 +394,11 @@ def read_chain_pos(chain, lookup):
 		elif child.tag == 'PosLookupRecord':
 			output = int(child.find('LookupListIndex').get('value'))
 		else:
-			print('Unexpected in ChainContextPos', child)
+			unexpected('ChainContextPos', child, font)
 	posit = ChainPos(left, input, right, output)
 	lookup.add_positioning(posit)
 
-def read_ext_subst(ext, lookup):
+def read_ext_subst(ext, lookup, font):
 	for child in ext.findall('*'):
 		if child.tag is None:
 			None
@@ -394,17 +411,18 @@ def read_ext_subst(ext, lookup):
 		elif child.tag == 'LigatureSubst':
 			read_ligature_subst(child, lookup)
 		elif child.tag == 'ChainContextSubst' and child.get('Format') == '3':
-			read_chain_subst3(child, lookup)
+			read_chain_subst3(child, lookup, font)
 		elif child.tag == 'ReverseChainSingleSubst':
-			read_reverse_subst(child, lookup)
+			read_reverse_subst(child, lookup, font)
 		else:
-			print('Unexpected in ExtensionSubst', child)
+			unexpected('ExtensionSubst', child, font)
 
 def read_GSUB_lookup(lookup_elem, font):
 	index = int(lookup_elem.get('index'))
-	typ = '1'
 	if lookup_elem.find('.//ExtensionLookupType') is not None:
 		typ = '7/' + lookup_elem.find('.//ExtensionLookupType').get('value')
+	else:
+		typ = lookup_elem.find('LookupType').get('value')
 	if lookup_elem.find('.//ChainContextSubst') is not None:
 		typ += '.' + lookup_elem.find('.//ChainContextSubst').get('Format')
 	lookup = GSUB_Lookup(index, typ)
@@ -414,16 +432,26 @@ def read_GSUB_lookup(lookup_elem, font):
 		elif child.tag == 'LookupFlag':
 			read_flag(child, lookup)
 		elif child.tag == 'ExtensionSubst':
-			read_ext_subst(child, lookup)
+			read_ext_subst(child, lookup, font)
 		elif child.tag == 'SingleSubst':
 			read_single_subst(child, lookup)
+		elif child.tag == 'MultipleSubst':
+			read_mult_subst(child, lookup)
+		elif child.tag == 'LigatureSubst':
+			read_ligature_subst(child, lookup)
+		elif child.tag == 'ChainContextSubst' and child.get('Format') == '3':
+			read_chain_subst3(child, lookup, font)
+		elif child.tag == 'ReverseChainSingleSubst':
+			read_reverse_subst(child, lookup, font)
 		elif child.tag == 'MarkFilteringSet':
 			lookup.filter_set = int(child.get('value'))
 		else:
-			print('Unexpected in GSUB Lookup', child)
+			unexpected('GSUB Lookup', child, font)
 	font.add_GSUB_lookup(index, lookup)
 
 def read_GSUB(table, font):
+	if table is None:
+		return
 	scripttag_elem = table.find('.//ScriptTag')
 	font.script = scripttag_elem.get('value')
 	for f_record_elem in table.findall('FeatureList/FeatureRecord'):
@@ -438,26 +466,29 @@ def read_GSUB(table, font):
 	for lookup_elem in lookup_elems:
 		read_GSUB_lookup(lookup_elem, font)
 
-def read_ext_pos(ext, lookup):
+def read_ext_pos(ext, lookup, font):
 	for child in ext.findall('*'):
 		if child.tag is None:
 			None
 		elif child.tag == 'ExtensionLookupType':
 			None
 		elif child.tag == 'SinglePos':
-			read_single_pos(child, lookup)
+			read_single_pos(child, lookup, font)
 		elif child.tag == 'MarkBasePos':
-			read_mark_base_pos(child, lookup)
+			read_mark_base_pos(child, lookup, font)
 		elif child.tag == 'MarkMarkPos':
-			read_mark_mark_pos(child, lookup)
+			read_mark_mark_pos(child, lookup, font)
 		elif child.tag == 'ChainContextPos':
-			read_chain_pos(child, lookup)
+			read_chain_pos(child, lookup, font)
 		else:
-			print('Unexpected in ExtensionSubst', child)
+			unexpected('ExtensionSubst', child, font)
 
 def read_GPOS_lookup(lookup_elem, font):
 	index = int(lookup_elem.get('index'))
-	typ ='9/' +  lookup_elem.find('.//ExtensionLookupType').get('value')
+	if lookup_elem.find('.//ExtensionLookupType') is not None:
+		typ = '9/' + lookup_elem.find('.//ExtensionLookupType').get('value')
+	else:
+		typ = lookup_elem.find('LookupType').get('value')
 	lookup = GPOS_Lookup(index, typ)
 	for child in lookup_elem.findall('*'):
 		if child.tag == 'LookupType':
@@ -465,14 +496,24 @@ def read_GPOS_lookup(lookup_elem, font):
 		elif child.tag == 'LookupFlag':
 			read_flag(child, lookup)
 		elif child.tag == 'ExtensionPos':
-			read_ext_pos(child, lookup)
+			read_ext_pos(child, lookup, font)
+		elif child.tag == 'SinglePos':
+			read_single_pos(child, lookup, font)
+		elif child.tag == 'MarkBasePos':
+			read_mark_base_pos(child, lookup, font)
+		elif child.tag == 'MarkMarkPos':
+			read_mark_mark_pos(child, lookup, font)
+		elif child.tag == 'ChainContextPos':
+			read_chain_pos(child, lookup, font)
 		elif child.tag == 'MarkFilteringSet':
 			lookup.filter_set = int(child.get('value'))
 		else:
-			print('Unexpected in GPOS Lookup', child)
+			unexpected('GPOS Lookup', child, font)
 	font.add_GPOS_lookup(index, lookup)
 
 def read_GPOS(table, font):
+	if table is None:
+		return
 	f_index_elems = table.findall('.//FeatureIndex')
 	for f_index_elem in f_index_elems:
 		f_index = f_index_elem.get('value')
@@ -488,8 +529,9 @@ def read_GPOS(table, font):
 	for lookup_elem in lookup_elems:
 		read_GPOS_lookup(lookup_elem, font)
 
-def read_ttx(filename):
+def read_ttx(filename, hooks=None):
 	font = Font()
+	font.hooks = hooks
 	doc = etree.parse(filename)
 	read_properties(doc, 'head', font)
 	read_properties(doc, 'hhea', font)
@@ -516,4 +558,5 @@ def read_ttx(filename):
 	read_MarkGlyphSetsDef(doc.find('GDEF/MarkGlyphSetsDef'), font)
 	read_GSUB(doc.find('GSUB'), font)
 	read_GPOS(doc.find('GPOS'), font)
+	font.compile()
 	return font
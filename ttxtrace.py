@@ -0,0 +1,118 @@
+# How much of the shaping is kept: nothing, the number of applications of
+# each lookup, or every application with the buffer after it.
+TRACE_OFF = 0
+TRACE_COUNTS = 1
+TRACE_FULL = 2
+
+# Record of one application of a lookup. Instead of copies of the buffer it
+# holds how many edits and adjustments of the history had been made when the
+# application was done; the glyphs and positionings at that point are
+# rebuilt from the history when asked for. Can be read as the dict it
+# replaces, with keys 'feature', 'index', 'posses', 'rule', 'tokens' and,
+# for positioning, 'positionings'.
+class Application:
+	__slots__ = ('feature', 'index', 'posses', 'rule', 'history', 'step', 'adjusted')
+
+	def __init__(self, index, posses, rule, history, positioning=False):
+		self.feature = None
+		self.index = index
+		self.posses = posses
+		self.rule = rule
+		self.history = history
+		self.step = len(history.edits) if history is not None else 0
+		if positioning:
+			self.adjusted = len(history.adjustments) if history is not None else 0
+		else:
+			self.adjusted = None
+
+	def __getitem__(self, key):
+		if key == 'tokens' and self.history is not None:
+			return self.history.tokens(self.step)
+		elif key == 'positionings' and self.history is not None and self.adjusted is not None:
+			return self.history.positionings(self.adjusted)
+		elif key in ('feature', 'index', 'posses', 'rule'):
+			return getattr(self, key)
+		raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		if key not in ('feature', 'index', 'posses', 'rule'):
+			raise KeyError(key)
+		setattr(self, key, value)
+
+	def __contains__(self, key):
+		if key == 'tokens':
+			return self.history is not None
+		elif key == 'positionings':
+			return self.history is not None and self.adjusted is not None
+		return key in ('feature', 'index', 'posses', 'rule')
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	# A record of the same application, sharing the history, which is not
+	# changed once the shaping is done.
+	def copy(self):
+		a = Application.__new__(Application)
+		for key in self.__slots__:
+			setattr(a, key, getattr(self, key))
+		return a
+
+# Copy of applications as traced with any of the trace levels.
+def copy_applications(applications):
+	if isinstance(applications, dict):
+		return dict(applications)
+	return [a.copy() for a in applications]
+
+# The edits of the glyph buffer and the adjustments of the positionings,
+# in the order in which they were made. An edit is the position, the
+# glyphs removed and the glyphs inserted; an adjustment is the position
+# and the old and new positioning of the glyph there.
+class History:
+	def __init__(self, glyphs, names=None):
+		self.glyphs = list(glyphs)
+		self.names = names
+		self.edits = []
+		self.adjustments = []
+		# The glyphs after the first cached_step edits
+		self.cached_step = 0
+		self.cached = list(glyphs)
+		# The positionings after the first cached_adjusted adjustments
+		self.cached_adjusted = 0
+		self.cached_positionings = None
+
+	# The glyphs after the first step edits, as names if the history has
+	# a function from glyph IDs to names. Going from the cached glyphs, edits are
+	# redone forwards or undone backwards.
+	def tokens(self, step):
+		glyphs = self.cached
+		while self.cached_step < step:
+			pos, removed, inserted = self.edits[self.cached_step]
+			glyphs[pos:pos+len(removed)] = inserted
+			self.cached_step += 1
+		while self.cached_step > step:
+			self.cached_step -= 1
+			pos, removed, inserted = self.edits[self.cached_step]
+			glyphs[pos:pos+len(inserted)] = removed
+		if self.names is None:
+			return list(glyphs)
+		return self.names(glyphs)
+
+	# The positionings after the first step adjustments, from the cached
+	# ones as for the glyphs.
+	def positionings(self, step):
+		positionings = self.cached_positionings
+		if positionings is None:
+			positionings = [{} for glyph in self.tokens(len(self.edits))]
+			self.cached_positionings = positionings
+		while self.cached_adjusted < step:
+			pos, before, after = self.adjustments[self.cached_adjusted]
+			positionings[pos] = after
+			self.cached_adjusted += 1
+		while self.cached_adjusted > step:
+			self.cached_adjusted -= 1
+			pos, before, after = self.adjustments[self.cached_adjusted]
+			positionings[pos] = before
+		return list(positionings)
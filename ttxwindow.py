@@ -0,0 +1,451 @@
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+from ttxbuffer import GlyphBuffer, PositionBuffer
+
+# Shaping a part of a sequence on its own, as in reshaping around an edit
+# (cf. Simulator.edit) or shaping a stream a window at a time (cf.
+# Font.shape_stream), gives what shaping the whole gives only where no
+# lookup sees past the part. A rule starts at a trigger of its lookup and
+# sees back and ahead of it so many glyphs that the lookup keeps (cf.
+# LookupReach), however many glyphs are skipped in between, and matches
+# those up to where it stops (cf. Sight). So the state before every lookup
+# is recorded (cf. Stages), and where, in it, no rule of a trigger on one
+# side matches glyphs on the other, the lookup does the same on either
+# side (cf. cut_points). After an edit, each lookup is applied anew only to
+# the glyphs that differ from before, widened to such cuts (cf. reshape).
+# Where a shaping may be followed by more input, as in a stream, only the
+# glyphs before its safe end (cf. safe_end) stay the same whatever follows,
+# and it may be cut only where no rule of a trigger, nor of one that may
+# yet come, matches glyphs on both sides (cf. stream_crossings).
+
+# The glyphs before the first GSUB lookup and after each, with their
+# clusters, and the positionings after each GPOS lookup, as values and
+# whether given (cf. PositionBuffer). States that a lookup left unchanged
+# are shared.
+class Stages:
+	def __init__(self):
+		self.glyphs = []
+		self.positionings = []
+		self.version = None
+		self.bounds = None
+		# The extents of the triggers in the state before each lookup, for
+		# each part of its reach (cf. extents), by the index of the lookup,
+		# GSUB then GPOS
+		self.extent = {}
+
+	def add_glyphs(self, tokens):
+		if len(self.glyphs) > 0 and tokens.version == self.version:
+			self.glyphs.append(self.glyphs[-1])
+		else:
+			self.glyphs.append((tokens.snapshot(), tokens.clusters()))
+			self.version = tokens.version
+
+	def add_positionings(self, positionings):
+		self.positionings.append((positionings.values.copy(), positionings.given.copy()))
+
+	def n_in(self):
+		return len(self.glyphs[0][0])
+
+	# Whether at each input token, and at the end, a cluster starts in every
+	# state, as an array
+	def boundaries(self):
+		if self.bounds is None:
+			n_in = self.n_in()
+			bounds = np.ones(n_in + 1, dtype=np.bool_)
+			seen = set()
+			for entry in self.glyphs:
+				if id(entry) not in seen:
+					seen.add(id(entry))
+					starts = np.zeros(n_in + 1, dtype=np.bool_)
+					starts[np.frombuffer(entry[1], dtype=np.uint32)] = True
+					bounds &= starts
+			bounds[0] = bounds[n_in] = True
+			self.bounds = bounds
+		return self.bounds
+
+	def extents(self, k, state, reach):
+		if k not in self.extent:
+			self.extent[k] = [extents(Sight(state[0], state[1], part)) for part in reach.parts]
+		return self.extent[k]
+
+	# Where the state before the kth lookup may be cut (cf. cut_points)
+	def cuts(self, k, state, reach, boundaries):
+		return cut_points(self.extents(k, state, reach), state[1], boundaries)
+
+	# The state before each lookup, GSUB then GPOS, with each part of its
+	# reach
+	def before_lookups(self, GSUB_reaches, GPOS_reaches):
+		return [(glyphs, part) for glyphs, reach in zip(self.glyphs, GSUB_reaches) for part in reach.parts] + \
+			[(self.glyphs[-1], part) for reach in GPOS_reaches for part in reach.parts]
+
+# How far the rules of the triggers of a part of a lookup's reach (cf.
+# LookupReach) see in the glyphs before it, with their clusters: back and
+# ahead of a trigger, glyph by glyph that the lookup keeps, as long as some
+# rule goes on with the glyphs seen so far, up to the reach. The glyph at
+# which the rules stop is seen as well, as they compare it.
+class Sight:
+	def __init__(self, glyphs, clusters, reach):
+		self.reach = reach
+		self.clusters = clusters
+		self.ids = np.frombuffer(glyphs, dtype=np.uint16)
+		self.kept = reach.kept(glyphs)
+		self.kept_at = np.flatnonzero(self.kept)
+		self.triggered = reach.triggered(glyphs)
+
+	def __len__(self):
+		return len(self.ids)
+
+	# The position of the glyphs from the input token, or past them
+	def position(self, token):
+		return bisect_left(self.clusters, token)
+
+	# The positions of the triggers from lo to hi, as an array
+	def triggers(self, lo, hi):
+		return lo + np.flatnonzero(self.triggered[lo:hi])
+
+	# For the triggers at where, where the glyphs their rules may change end:
+	# past as many kept glyphs after the trigger as the reach has inputs, or
+	# at the end if there are fewer
+	def changes(self, where):
+		where = np.asarray(where, dtype=np.int64)
+		if self.reach.inputs == 0:
+			return where + 1
+		i = np.searchsorted(self.kept_at, where, 'right') + self.reach.inputs - 1
+		return np.append(self.kept_at + 1, len(self.ids))[np.minimum(i, len(self.kept_at))]
+
+	# As sees back, with the changed glyphs of the reach, if any, matched,
+	# and not counted if they may have become fewer (cf. LookupReach): the
+	# rules see back to the first glyph that is neither changed nor
+	# matched, or to as many counted as the reach
+	def behind(self, where):
+		changed = self.reach.changed
+		if changed is None or len(where) == 0:
+			return self.sees(where, self.reach.back, self.reach.backward, -1)
+		where = np.asarray(where, dtype=np.int64)
+		ids = self.ids[self.kept_at]
+		free = np.isin(ids, changed)
+		matched = free | np.isin(ids, self.reach.backward[0])
+		counted = matched & ~free if self.reach.fewer else matched
+		stops = np.flatnonzero(~matched)
+		counted_at = np.flatnonzero(counted)
+		# The kept glyphs before each trigger, the last stop among them, and
+		# the farthest counted one seen, or -1
+		i = np.searchsorted(self.kept_at, where, 'left')
+		stop = np.append(stops, -1)[np.searchsorted(stops, i, 'left') - 1]
+		k = np.searchsorted(counted_at, i, 'left') - self.reach.back
+		farthest = np.append(counted_at, -1)[np.where(k >= 0, k, -1)]
+		first = np.maximum(stop + 1, farthest)
+		more = (stop < 0) & (farthest < 0)
+		kept_at = np.append(self.kept_at, 0)
+		needed = np.where(first < i, kept_at[first], where)
+		last = np.where((stop >= 0) & (stop + 1 > farthest), kept_at[stop], needed)
+		return last, more, needed
+
+	# The last glyph seen counting so many kept glyphs from the triggers at
+	# where, in the given direction, while they match the sets of glyph IDs,
+	# whether the rules would see more past the glyphs, and the last glyph
+	# seen that matched
+	def sees(self, where, count, sets, step):
+		where = np.asarray(where, dtype=np.int64)
+		if count == 0 or len(where) == 0:
+			return where, np.zeros(len(where), dtype=np.bool_), where
+		if len(self.kept_at) == 0:
+			return where, np.ones(len(where), dtype=np.bool_), where
+		if step > 0:
+			offsets = np.searchsorted(self.kept_at, where, 'right')[:, None] + np.arange(count)
+		else:
+			offsets = np.searchsorted(self.kept_at, where, 'left')[:, None] - 1 - np.arange(count)
+		valid = (offsets >= 0) & (offsets < len(self.kept_at))
+		at = self.kept_at[np.clip(offsets, 0, len(self.kept_at) - 1)]
+		matched = valid.copy()
+		for k, ids in enumerate(sets):
+			if ids is not None:
+				matched[:, k] &= np.isin(self.ids[at[:, k]], ids)
+		seen = valid.copy()
+		seen[:, 1:] &= np.logical_and.accumulate(matched[:, :-1], axis=1)
+		n_seen = seen.sum(axis=1)
+		rows = np.arange(len(where))
+		last = np.where(n_seen > 0, at[rows, np.maximum(n_seen - 1, 0)], where)
+		more = (n_seen < count) & ~valid[rows, np.minimum(n_seen, count - 1)]
+		n_matched = n_seen - ((n_seen > 0) & ~matched[rows, np.maximum(n_seen - 1, 0)])
+		needed = np.where(n_matched > 0, at[rows, np.maximum(n_matched - 1, 0)], where)
+		return last, more, needed
+
+# The input token before which the glyphs and positionings of a shaping
+# stay the same whatever input follows. Lookup by lookup, the input tokens
+# whose glyphs may change are marked, starting from the end, where the
+# input that follows goes. The rule a trigger applies may change if the
+# glyphs its rules see (cf. extents) may, or, as the lookup passes
+# forwards, if it is among the glyphs matched from such a trigger or sees
+# back any of them, which the lookup will have changed first; passing
+# backwards, if it sees ahead such a trigger. The glyphs matched from it
+# may then change, as may positionings in a GPOS lookup. Rules that may
+# start before the input are not counted: in a stream (cf.
+# Font.shape_stream), the input starts within glyphs yielded already,
+# which nothing that follows changes.
+def safe_end(stages, GSUB_reaches, GPOS_reaches):
+	n_in = stages.n_in()
+	changing = np.zeros(n_in + 1, dtype=np.bool_)
+	changing[n_in] = True
+	glyphs, clusters = stages.glyphs[-1]
+	for (glyphs, clusters), reach in list(zip(stages.glyphs, GSUB_reaches)) + \
+			[(stages.glyphs[-1], reach) for reach in GPOS_reaches]:
+		starts, ends = token_spans(clusters, n_in)
+		may = spans_marked(changing, starts, ends)
+		changed = np.zeros(len(may), dtype=np.bool_)
+		for part in reach.parts:
+			changed |= changed_positions(extents(Sight(glyphs, clusters, part)), may, part.reverse)
+		where = np.flatnonzero(changed[:-1])
+		marks = np.zeros(n_in + 2, dtype=np.int64)
+		np.add.at(marks, starts[where], 1)
+		np.add.at(marks, ends[where], -1)
+		changing |= np.cumsum(marks)[:n_in + 1] > 0
+	starts, ends = token_spans(clusters, n_in)
+	first = int(np.argmax(spans_marked(changing, starts, ends)))
+	return int(starts[first]) if first < len(starts) else n_in
+
+# For the glyphs with the given clusters, the input tokens from which and
+# up to which each comes, as arrays.
+def token_spans(clusters, n_in):
+	starts = np.frombuffer(clusters, dtype=np.uint32).astype(np.int64)
+	ends = np.append(starts, n_in)[np.searchsorted(starts, starts, 'right')]
+	return starts, ends
+
+# For glyphs from the tokens from starts to ends, and for the end, whether
+# any of these is marked, as an array.
+def spans_marked(marked, starts, ends):
+	counts = np.concatenate([[0], np.cumsum(marked)])
+	return np.append(counts[ends] - counts[starts] > 0, marked[-1])
+
+# For each position in a state before a lookup and for the end, whether the
+# lookup, with the given extents for a part of its reach, may change the
+# glyph or positioning there if those that may are given (cf. safe_end).
+def changed_positions(extent, may, reverse):
+	at, start, end, changes_end = extent[0], np.maximum(extent[1], 0), extent[2], extent[5]
+	counts = np.concatenate([[0], np.cumsum(may)])
+	hit = counts[end] - counts[start] > 0
+	if not reverse and hit.any():
+		# The end of the glyphs that the triggers so far that may apply
+		# another rule may change
+		reached = -1
+		for j in range(int(np.argmax(hit)), len(at)):
+			if hit[j] or start[j] < reached:
+				hit[j] = True
+				reached = max(reached, int(changes_end[j]))
+	elif reverse:
+		# The first trigger ahead so far that may apply another rule
+		reached = len(may)
+		for j in range(len(at) - 1, -1, -1):
+			if hit[j] or reached < end[j]:
+				hit[j] = True
+				reached = int(at[j])
+	marks = np.zeros(len(may) + 1, dtype=np.int64)
+	np.add.at(marks, at[hit], 1)
+	np.add.at(marks, changes_end[hit], -1)
+	return np.cumsum(marks)[:len(may)] > 0
+
+# For each input token of a shaping that may be followed by more input,
+# and for the end, how many rules match glyphs on both sides of it (cf.
+# cut_points), in the states before all lookups: the rules of the triggers
+# before the safe end safe (cf. safe_end), which see nothing that follows,
+# and, for each part of a lookup's reach, one of a trigger from safe on
+# that sees back as far as any can, whatever the glyphs up to it. Where a
+# cluster does not start in every state, the count is the largest there is.
+def stream_crossings(stages, safe, GSUB_reaches, GPOS_reaches):
+	n_in = stages.n_in()
+	tokens = np.arange(n_in + 1)
+	crossings = np.zeros(n_in + 1, dtype=np.int64)
+	for (glyphs, clusters), reach in stages.before_lookups(GSUB_reaches, GPOS_reaches):
+		sight = Sight(glyphs, clusters, reach)
+		p = sight.position(safe)
+		if reach.changed is not None:
+			reached = sight.behind([p])[2][0]
+		else:
+			sets = [None] * reach.back
+			if reach.back > 0 and all(ids is not None for ids in reach.backward):
+				sets = [np.unique(np.concatenate(reach.backward))] * reach.back
+			reached = sight.sees([p], reach.back, sets, -1)[2][0]
+		extent = extents(sight, sight.triggers(0, p))
+		n = len(sight)
+		crossed = np.zeros(n + 2, dtype=np.int64)
+		np.add.at(crossed, extent[3] + 1, 1)
+		np.add.at(crossed, extent[4], -1)
+		crossed[reached + 1] += 1
+		crossings += np.cumsum(crossed)[np.searchsorted(np.frombuffer(clusters, dtype=np.uint32), tokens)]
+	crossings[~stages.boundaries()] = np.iinfo(np.int64).max
+	return crossings
+
+# For the triggers of a part of a lookup's reach in a state, or those at
+# where, as rows: their positions, where the glyphs their rules see start
+# and end, before and past the ends of the state if they would see more,
+# where the glyphs they match start and end, and where those they may
+# change end (cf. Sight).
+def extents(sight, where=None):
+	if where is None:
+		where = sight.triggers(0, len(sight))
+	first, more_back, needed_start = sight.behind(where)
+	last, more_ahead, needed_last = sight.sees(where, sight.reach.ahead, sight.reach.onward, 1)
+	return np.array([where, np.where(more_back, -1, first), np.where(more_ahead, len(sight) + 1, last + 1), \
+		needed_start, needed_last + 1, sight.changes(where)], dtype=np.int64).reshape(6, -1)
+
+# The extents (cf. above) in the state of sight, which has the glyphs from
+# lo to hi_new in the place of those from lo to hi_old of a state whose
+# extents are old: those of the triggers that see none of these are moved
+# along, and the others found again.
+def moved_extents(old, sight, lo, hi_old, hi_new):
+	at, start, end = old[0], old[1], old[2]
+	before = (at < lo) & (end <= lo)
+	after = (at >= hi_old) & (start >= hi_old)
+	where = np.concatenate([at[(at < lo) & ~before], sight.triggers(lo, hi_new), \
+		at[(at >= hi_old) & ~after] + hi_new - hi_old])
+	return np.concatenate([old[:, before], extents(sight, where), old[:, after] + hi_new - hi_old], axis=1)
+
+# Where a state before a lookup, with the given clusters and extents for
+# each part of the lookup's reach, may be cut with the lookup doing the
+# same on either side: at each position, and at the end, whether no rule
+# of a trigger on one side matches glyphs on the other, and, with
+# boundaries, whether a cluster starts there, as an array.
+def cut_points(parts, clusters, boundaries):
+	n = len(clusters)
+	crossed = np.zeros(n + 1, dtype=np.int64)
+	for extent in parts:
+		np.add.at(crossed, extent[3] + 1, 1)
+		np.add.at(crossed, extent[4], -1)
+	free = np.cumsum(crossed) == 0
+	if boundaries and n > 1:
+		clusters = np.frombuffer(clusters, dtype=np.uint32)
+		free[1:n] &= clusters[1:] != clusters[:-1]
+	return free
+
+# The positions from which, and up to which, the arrays of a and b differ,
+# given in pairs with the positions along the last of at most two axes:
+# the same before the first, and the same from the last of a and of b to
+# the end.
+def differing(pairs):
+	n_a, n_b = pairs[0][0].shape[-1], pairs[0][1].shape[-1]
+	m = min(n_a, n_b)
+	head = np.zeros(m, dtype=np.bool_)
+	tail = np.zeros(m, dtype=np.bool_)
+	for a, b in pairs:
+		if a.ndim > 1:
+			head |= (a[:, :m] != b[:, :m]).any(axis=0)
+			tail |= (a[:, n_a-m:] != b[:, n_b-m:]).any(axis=0)
+		else:
+			head |= a[:m] != b[:m]
+			tail |= a[n_a-m:] != b[n_b-m:]
+	where = np.flatnonzero(head)
+	first = int(where[0]) if len(where) > 0 else m
+	where = np.flatnonzero(tail[first:])
+	same = m - first - (int(where[-1]) + 1 if len(where) > 0 else 0)
+	return first, n_a - same, n_b - same
+
+# The stages of shaping the glyphs ids, from those of shaping old, in whose
+# input the tokens from start to end were replaced by those that make ids
+# differ. Lookup by lookup, the glyphs from which and up to which the
+# states before it differ, with their positionings, are applied to anew,
+# along with those the rules of its triggers match around them, up to
+# where both states may be cut (cf. cut_points); around that, the state
+# after it is that of old. The number of glyphs each lookup was applied to
+# is kept as reshaped.
+def reshape(font, plan, old, ids, start, end, GSUB_reaches, GPOS_reaches):
+	delta = len(ids) - old.n_in()
+	translated = {}
+	# The clusters of glyphs of old, as in the edited input
+	def moved(clusters):
+		if id(clusters) not in translated:
+			shifted = np.frombuffer(clusters, dtype=np.uint32).astype(np.int64)
+			shifted[shifted >= end] += delta
+			translated[id(clusters)] = (clusters, shifted)
+		return translated[id(clusters)][1]
+	new = Stages()
+	new.reshaped = []
+	state = (array('H', ids), array('I', range(len(ids))))
+	new.glyphs.append(state)
+	lo, hi_old, hi_new = start, end, end + delta
+	for k, ((lookup, tag), reach) in enumerate(zip(plan.GSUB_lookups, GSUB_reaches)):
+		before, after = old.glyphs[k], old.glyphs[k+1]
+		if lo == hi_old == hi_new:
+			new.reshaped.append(0)
+			if k in old.extent:
+				new.extent[k] = old.extent[k]
+			if after is not before:
+				state = (after[0], array('I', moved(after[1]).astype(np.uint32).tobytes()))
+		elif after is before and not reach.triggered(state[0]).any():
+			new.reshaped.append(0)
+		else:
+			new.extent[k] = [moved_extents(extent, Sight(state[0], state[1], part), lo, hi_old, hi_new) \
+				for extent, part in zip(old.extents(k, before, reach), reach.parts)]
+			begin, stop, new_stop = widened(old.cuts(k, before, reach, True), new.cuts(k, state, reach, True), \
+				lo, hi_old, hi_new)
+			applied = GlyphBuffer(state[0][begin:new_stop])
+			applied.info_clusters = state[1][begin:new_stop]
+			apply_lookup(font, lookup, tag, applied)
+			new.reshaped.append(new_stop - begin)
+			if after is not before or applied.version > 0:
+				i = bisect_left(after[1], before[1][begin]) if begin < len(before[0]) else len(after[0])
+				j = bisect_left(after[1], before[1][stop]) if stop < len(before[0]) else len(after[0])
+				glyphs, clusters = applied.snapshot(), applied.clusters()
+				shifted = moved(after[1])
+				state = (after[0][:i] + glyphs + after[0][j:], array('I', shifted[:i].astype(np.uint32).tobytes()) + \
+					clusters + array('I', shifted[j:].astype(np.uint32).tobytes()))
+				lo, hi_old, hi_new = [i + d for d in differing([(np.frombuffer(after[0], dtype=np.uint16)[i:j], \
+					np.frombuffer(glyphs, dtype=np.uint16)), (moved(after[1])[i:j], np.frombuffer(clusters, dtype=np.uint32))])]
+		new.glyphs.append(state)
+	before, glyphs = old.glyphs[-1], state
+	k_GSUB = len(GSUB_reaches)
+	glyph_lo, glyph_hi_old, glyph_hi_new = lo, hi_old, hi_new
+	new_values = np.zeros((len(PositionBuffer.keys), len(glyphs[0])), dtype=np.int32), \
+		np.zeros((len(PositionBuffer.keys), len(glyphs[0])), dtype=np.bool_)
+	for k, ((lookup, tag), reach) in enumerate(zip(plan.GPOS_lookups, GPOS_reaches)):
+		after = old.positionings[k]
+		if lo == hi_old == hi_new:
+			new.reshaped.append(0)
+			new_values = after
+		elif not reach.triggered(glyphs[0]).any() and not reach.triggered(before[0]).any():
+			new.reshaped.append(0)
+		else:
+			new.extent[k_GSUB + k] = [moved_extents(extent, Sight(glyphs[0], glyphs[1], part), \
+				glyph_lo, glyph_hi_old, glyph_hi_new) for extent, part in \
+				zip(old.extents(k_GSUB + k, before, reach), reach.parts)]
+			begin, stop, new_stop = widened(old.cuts(k_GSUB + k, before, reach, False), \
+				new.cuts(k_GSUB + k, glyphs, reach, False), lo, hi_old, hi_new)
+			applied = GlyphBuffer(glyphs[0][begin:new_stop])
+			applied.info_clusters = glyphs[1][begin:new_stop]
+			positionings = PositionBuffer(0)
+			positionings.values = new_values[0][:, begin:new_stop].copy()
+			positionings.given = new_values[1][:, begin:new_stop].copy()
+			positionings = apply_lookup(font, lookup, tag, applied, positionings)
+			new.reshaped.append(new_stop - begin)
+			new_values = tuple(np.concatenate([a[:, :begin], b, a[:, stop:]], axis=1) \
+				for a, b in zip(after, (positionings.values, positionings.given)))
+			lo, hi_old, hi_new = [begin + d for d in differing([ \
+				(np.frombuffer(before[0], dtype=np.uint16)[begin:stop], np.frombuffer(glyphs[0], dtype=np.uint16)[begin:new_stop]), \
+				(moved(before[1])[begin:stop], np.frombuffer(glyphs[1], dtype=np.uint32)[begin:new_stop])] + \
+				[(a[:, begin:stop], b[:, begin:new_stop]) for a, b in zip(after, new_values)])]
+		new.positionings.append(new_values)
+	return new
+
+# The glyphs from lo to hi_old of a state before a lookup, and from lo to
+# hi_new of another, widened on both to where both may be cut, given as
+# old_cuts and new_cuts (cf. cut_points).
+def widened(old_cuts, new_cuts, lo, hi_old, hi_new):
+	begin = int(np.flatnonzero(old_cuts[:lo+1] & new_cuts[:lo+1])[-1])
+	stop = hi_old + int(np.flatnonzero(old_cuts[hi_old:] & new_cuts[hi_new:])[0])
+	return begin, stop, stop + hi_new - hi_old
+
+# Applies a lookup to glyphs, a GlyphBuffer, as Font.apply_ids does, with
+# positionings for a GPOS lookup, and returns these.
+def apply_lookup(font, lookup, tag, glyphs, positionings=None):
+	hooks = font.hooks
+	if hooks is not None:
+		hooks.lookup_start(lookup, tag, glyphs)
+	if positionings is None:
+		applications = lookup.apply(glyphs, font)
+	else:
+		positionings, applications = lookup.apply(glyphs, positionings, font)
+	if hooks is not None:
+		hooks.lookup_end(lookup, tag, glyphs, applications)
+	return positionings
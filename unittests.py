@@ -1,14 +1,19 @@
 import os
+import random
 import string
 import subprocess
 
 # Tests various substitutions by creating fonts.
 
 from ttxtables import read_cmap, read_extra_names, read_name, read_glyf
-from ttxfont import starter_font, Feature, MARK_GLYPH, \
+from ttxfont import starter_font, Feature, BASE_GLYPH, LIGATURE_GLYPH, MARK_GLYPH, \
 	SingleSubstitution1, MultSubstitution, LigSubstitution, ChainSubstitution3, ReverseSubstitution, \
-	Simulator
+	GPOS_Lookup, SingleAdjustment, MarkBaseAttachment, MarkMarkAttachment, \
+	Simulator, TRACE_OFF, TRACE_COUNTS, TRACE_FULL
 from ttxwrite import write_ttx
+from ttxread import read_ttx
+from ttxprofile import LookupProfiler
+from benchmark import eot_ttx, eot_sequences, andromeda_sequences
 
 data_dir = 'data'
 gen_dir = 'generated'
@@ -272,6 +277,339 @@ def test_type8ext():
 	ttx_to_ttx(filename, filename_tmp, filename_copy)
 	simulate_subst(font, ['A','A','A'], '78')
 
+# Type 4 substitution skipping marks. A glyph made a mark after shaping
+# is skipped when shaping again, also with a render cache.
+def test_class_change():
+	font = capital_font()
+	liga = Feature('liga')
+	lookup = font.new_GSUB_lookup('4', feat=liga)
+	lookup.ignore_marks = True
+	lookup.add(LigSubstitution(['A','B'], 'C'))
+	font.add_GSUB_feature(liga)
+	font.set_render_cache()
+	assert font.render(['A','M','B'])[0] == ['A','M','B']
+	font.glyph_to_class['M'] = MARK_GLYPH
+	assert font.render(['A','M','B'])[0] == ['C','M']
+	font.glyph_to_class = {}
+	assert font.render(['A','M','B'])[0] == ['A','M','B']
+
+# Font whose lookups see past skipped marks, and from which the changes of
+# an edit spread over several lookups.
+def edit_font():
+	font = capital_font()
+	font.glyph_to_class['M'] = MARK_GLYPH
+	font.glyph_to_class['N'] = MARK_GLYPH
+	calt = Feature('calt')
+	single = font.new_GSUB_lookup('1')
+	single.add(SingleSubstitution1('A', 'C'))
+	chain = font.new_GSUB_lookup('6.3', feat=calt)
+	chain.ignore_marks = True
+	chain.add(ChainSubstitution3([['D']], [['A']], [['B']], [(0, single.index)]))
+	chain.add(ChainSubstitution3([], [['A']], [['B']], [(0, single.index)]))
+	liga = font.new_GSUB_lookup('4', feat=calt)
+	liga.ignore_marks = True
+	liga.add(LigSubstitution(['C','B'], 'E'))
+	liga.add(LigSubstitution(['A','A'], 'F'))
+	mult = font.new_GSUB_lookup('2', feat=calt)
+	mult.add(MultSubstitution('F', ['G','M']))
+	reverse = font.new_GSUB_lookup('8', feat=calt)
+	reverse.ignore_marks = True
+	reverse.add(ReverseSubstitution([], ['G','H'], [['G','H','I']], ['H','I']))
+	single2 = font.new_GSUB_lookup('1', feat=calt)
+	single2.add(SingleSubstitution1('I', 'J'))
+	chain2 = font.new_GSUB_lookup('6.3', feat=calt)
+	chain2.add(ChainSubstitution3([['J']], [['X']], [], [(0, single.index)]))
+	font.add_GSUB_feature(calt)
+	return font
+
+# A chain rule sees past any number of skipped marks.
+def test_edit_skipped():
+	font = edit_font()
+	sim = Simulator(font)
+	sim.trace = TRACE_OFF
+	sim.set_tokens(['A'] + ['M'] * 8 + ['X'])
+	sim.edit(9, 10, ['B'])
+	assert sim.tokens == font.render(['A'] + ['M'] * 8 + ['B'], trace=TRACE_OFF)[0]
+	assert sim.tokens[0] == 'E'
+
+# Random edits of random sequences give what shaping in full gives.
+def test_edit_random():
+	font = edit_font()
+	rnd = random.Random(1)
+	alphabet = 'AABBDGHMMMMMMNXIJ'
+	for i in range(100):
+		sim = Simulator(font)
+		sim.trace = TRACE_OFF
+		sim.set_tokens([rnd.choice(alphabet) for j in range(rnd.randint(0, 60))])
+		for j in range(5):
+			start = rnd.randint(0, len(sim.in_tokens))
+			end = rnd.randint(start, min(len(sim.in_tokens), start + 3))
+			sim.edit(start, end, [rnd.choice(alphabet) for k in range(rnd.randint(0, 3))])
+			tokens, positionings, applications, places, clusters = \
+				font.render(sim.in_tokens, trace=TRACE_OFF, clusters=True)
+			assert sim.tokens == tokens
+			assert sim.positionings == positionings
+			assert sim.places == places
+			assert sim.clusters == clusters
+
+# With the applications traced, an edit keeps them.
+def test_edit_trace():
+	font = edit_font()
+	sim = Simulator(font)
+	sim.set_tokens(['A','M','X'])
+	sim.edit(2, 3, ['B'])
+	assert sim.tokens == ['E','M']
+	assert len(sim.applications) > 0
+
+# Edits of a long sequence in the eot font, whose lookups see far past
+# skipped glyphs, give what shaping in full gives, and apply the lookups to
+# fewer than half as many glyphs as shaping in full does.
+def test_edit_eot():
+	font = read_ttx(eot_ttx())
+	rnd = random.Random(3)
+	sim = Simulator(font)
+	sim.trace = TRACE_OFF
+	sim.suppressed = ['ss01', 'rtlm']
+	tokens = [token for sequence in eot_sequences(font, 60) for token in sequence + ['space']]
+	sim.set_tokens(tokens)
+	sim.edit(0, 0, [])
+	signs = sorted(set(tokens))
+	reshaped, full = 0, 0
+	for i in range(5):
+		start = rnd.randint(0, len(sim.in_tokens))
+		end = min(len(sim.in_tokens), start + rnd.randint(0, 2))
+		sim.edit(start, end, [rnd.choice(signs) for k in range(rnd.randint(0, 2))])
+		tokens, positionings, applications, places, clusters = \
+			font.render(sim.in_tokens, suppressed=sim.suppressed, trace=TRACE_OFF, clusters=True)
+		assert sim.tokens == tokens
+		assert sim.positionings == positionings
+		assert sim.places == places
+		reshaped += sum(sim.stages.reshaped)
+		full += sum(len(glyphs) for glyphs, clusters in sim.stages.glyphs[:-1]) + \
+			len(sim.stages.glyphs[-1][0]) * len(sim.stages.positionings)
+	assert reshaped < full / 2
+
+# A stream shapes as the whole sequence, a rule seeing past skipped marks
+# from one window into the next. In a window too small for the rule, the
+# stream is cut, and shapes on either side of the cut.
+def test_stream_skipped():
+	font = edit_font()
+	tokens = ['A'] + ['M'] * 600 + ['B']
+	assert [glyph for glyph, positioning, place in font.shape_stream(tokens)] == \
+		font.apply(tokens, trace=TRACE_OFF)[0]
+	assert [glyph for glyph, positioning, place in font.shape_stream(tokens, max_window=300)] == tokens
+
+# Random streams shape as the whole sequences, whatever the chunks.
+def test_stream_random():
+	font = edit_font()
+	rnd = random.Random(2)
+	alphabet = 'AABBDGHMMMMMMNXIJ'
+	for i in range(100):
+		tokens = [rnd.choice(alphabet) for j in range(rnd.randint(0, 300))]
+		out_tokens, positionings, applications, places = font.render(tokens, trace=TRACE_OFF)
+		stream = list(font.shape_stream(tokens, chunk=rnd.randint(1, 40), max_window=200))
+		assert [glyph for glyph, positioning, place in stream] == out_tokens
+		assert [place for glyph, positioning, place in stream] == places
+
+# A stream of text in a real font, many times as long as the window,
+# shapes as the whole text, the window being cut where no rule sees across.
+def test_stream_andromeda():
+	font = read_ttx(os.path.join('andromeda', 'AndromedaSL.ttx'))
+	tokens = [token for sequence in andromeda_sequences(font) * 10 for token in sequence]
+	out_tokens, positionings, applications, places = font.render(tokens, trace=TRACE_OFF)
+	stream = list(font.shape_stream(tokens, chunk=20, max_window=100))
+	assert len(tokens) > 10 * 100
+	assert [glyph for glyph, positioning, place in stream] == out_tokens
+	assert [positioning for glyph, positioning, place in stream] == positionings
+	assert [place for glyph, positioning, place in stream] == places
+
+# A profiler that does not observe positions leaves the lookups their
+# batch paths, and still times each pass.
+def test_profile_passes():
+	font = capital_font()
+	abvs = Feature('abvs')
+	lookup = font.new_GSUB_lookup('1', feat=abvs)
+	lookup.add(SingleSubstitution1('A', 'B'))
+	font.add_GSUB_feature(abvs)
+	tokens = ['A','C'] * 100
+	for per_position in [True, False]:
+		profiler = LookupProfiler(per_position=per_position)
+		assert font.apply(tokens, trace=TRACE_OFF, profiler=profiler)[0] == ['B','C'] * 100
+		row = profiler.report()[0]
+		assert row['passes'] == 1
+		assert row['matches'] == (100 if per_position else 0)
+
+# Places follow a width changed after shaping, with and without the cache.
+def test_width_change():
+	font = capital_font()
+	font.width['A'] = 100
+	font.width['B'] = 200
+	font.width['C'] = 400
+	for size in [None, 16]:
+		font.set_render_cache(size)
+		assert font.render(['A','B','C'], trace=TRACE_OFF)[3] == [(0, 0), (200, 0), (600, 0)]
+		font.width['B'] += 1000
+		assert font.shape(['A','B','C'], [{}, {}, {}]) == [(0, 0), (1200, 0), (1600, 0)]
+		assert font.render(['A','B','C'], trace=TRACE_OFF)[3] == [(0, 0), (1200, 0), (1600, 0)]
+		font.width['B'] -= 1000
+
+# Names the font does not know are shaped as glyphs no rule applies to,
+# come back in their places, and do not add glyphs to the font.
+def test_unknown_names():
+	font = edit_font()
+	font.compile()
+	n_glyphs = len(font.glyph_names)
+	tokens = ['A','x0','B','A','M','B'] + ['x' + str(i) for i in range(1, 70000)] + ['A','M','B']
+	result = font.apply(tokens, trace=TRACE_OFF)[0]
+	assert result[:5] == ['A','x0','B','E','M']
+	assert result[5:-2] == tokens[6:-3]
+	assert result[-2:] == ['E','M']
+	assert len(font.glyph_names) == n_glyphs
+	applications = font.apply(['x1','A','M','B','x2'])[2]
+	assert applications[-1]['tokens'] == ['x1','E','M','x2']
+	assert len(font.glyph_names) == n_glyphs
+
+# Rendering gives the same results, as copies, with or without the cache,
+# and the cache is cleared when the lookups change.
+def test_render_cache():
+	font = capital_font()
+	abvs = Feature('abvs')
+	lookup = font.new_GSUB_lookup('1', feat=abvs)
+	lookup.add(SingleSubstitution1('A', 'B'))
+	font.add_GSUB_feature(abvs)
+	uncached = font.render(['A','C'])
+	font.set_render_cache(16)
+	for i in range(3):
+		result = font.render(['A','C'])
+		assert result[:2] + result[3:] == uncached[:2] + uncached[3:]
+		assert [a['tokens'] for a in result[2]] == [a['tokens'] for a in uncached[2]]
+		assert type(result[1]) == type(uncached[1]) == list
+		assert result[2][0]['feature'] == 'abvs'
+		result[1][0]['XCoordinate'] = 100
+		result[2][0]['feature'] = 'test'
+	assert (font.render_cache.hits, font.render_cache.misses) == (2, 1)
+	lookup.add(SingleSubstitution1('C', 'D'))
+	assert font.render(['A','C'])[0] == ['B','D']
+	calt = Feature('calt')
+	lookup2 = font.new_GSUB_lookup('1', feat=calt)
+	lookup2.add(SingleSubstitution1('B', 'E'))
+	font.add_GSUB_feature(calt)
+	assert font.render(['A','C'])[0] == ['E','D']
+	assert font.render(['A','C'])[0] == ['E','D']
+	assert (font.render_cache.hits, font.render_cache.misses) == (3, 3)
+
+# Shaping many sequences gives the results in order, with the exception
+# raised for a sequence in its place, over workers and in this process.
+def test_shape_many():
+	font = capital_font()
+	abvs = Feature('abvs')
+	lookup = font.new_GSUB_lookup('1', feat=abvs)
+	lookup.add(SingleSubstitution1('A', 'B'))
+	font.add_GSUB_feature(abvs)
+	sequences = [['C'] * i + ['A'] if i % 3 else 'A' for i in range(30)]
+	for workers in [2, 1]:
+		results = font.apply_many(sequences, workers=workers, chunksize=4)
+		rendered = Simulator(font).shape_batch(sequences, workers=workers, chunksize=4)
+		assert len(results) == len(rendered) == len(sequences)
+		for i, sequence in enumerate(sequences):
+			if i % 3:
+				assert results[i][0] == ['C'] * i + ['B']
+				assert rendered[i][3] == font.render(sequence, trace=TRACE_OFF)[3]
+			else:
+				assert isinstance(results[i], KeyError)
+				assert isinstance(rendered[i], KeyError)
+
+# Font whose marks, some of them made by multiple substitutions, attach
+# to bases and to other marks, by lookups that skip some glyphs.
+def attach_font():
+	font = capital_font()
+	for c in 'ABCD':
+		font.glyph_to_class[c] = BASE_GLYPH
+	font.glyph_to_class['L'] = LIGATURE_GLYPH
+	for c in 'MNOP':
+		font.glyph_to_class[c] = MARK_GLYPH
+	font.mark_to_class.update({'M': 1, 'N': 1, 'O': 2, 'P': 2})
+	font.index_to_glyphs[0] = ['N', 'P']
+	ccmp = Feature('ccmp')
+	mult = font.new_GSUB_lookup('2', feat=ccmp)
+	mult.add(MultSubstitution('F', ['A','M','N']))
+	mult.add(MultSubstitution('G', ['L','O']))
+	mult.add(SingleSubstitution1('H', 'B'))
+	font.add_GSUB_feature(ccmp)
+	anchor = lambda x, y: {'x': x, 'y': y}
+	marks = [dict(anchor(10, 20), glyph='M', **{'class': '0'}), dict(anchor(5, 5), glyph='N', **{'class': '1'}), \
+		dict(anchor(7, 3), glyph='O', **{'class': '0'}), dict(glyph='P', **{'class': '1'})]
+	bases = [{'glyph': 'A', 'coordinates': {'0': anchor(100, 200), '1': anchor(150, 250)}}, \
+		{'glyph': 'B', 'coordinates': {'0': anchor(300, 400)}}, \
+		{'glyph': 'C', 'coordinates': {'1': anchor(50, 60)}}, {'glyph': 'L'}]
+	lookups = []
+	for t, rule, flags in [('1', SingleAdjustment(1, [{'glyph': 'B', 'placement': {'XAdvance': 30}}, \
+				{'glyph': 'M', 'placement': {'XPlacement': 1, 'YPlacement': 2}}]), {'ignore_marks': True}), \
+			('4', MarkBaseAttachment(marks, bases), {'ignore_ligatures': True}), \
+			('4', MarkBaseAttachment(marks[2:], bases[1:]), {'mark_class': 2}), \
+			('6', MarkMarkAttachment(marks[1:], marks), {'filter_set': 0}), \
+			('6', MarkMarkAttachment(marks[:2], marks[2:]), {'mark_class': 2})]:
+		lookup = GPOS_Lookup(len(font.GPOS_lookup_list), t)
+		lookup.add_positioning(rule)
+		for flag, value in flags.items():
+			setattr(lookup, flag, value)
+		font.add_GPOS_lookup(lookup.index, lookup)
+		lookups.append(lookup)
+	mark = Feature('mark')
+	for lookup in lookups:
+		mark.add_lookup_index(lookup.index)
+	font.add_GPOS_feature(mark)
+	return font
+
+# The applications of each lookup, counted as by TRACE_COUNTS.
+def count_applications(applications):
+	counts = {}
+	for a in applications:
+		counts[(a['feature'], a['index'])] = counts.get((a['feature'], a['index']), 0) + 1
+	return counts
+
+# The batch paths of the GPOS lookups, taken for long sequences without a
+# history, position as the lookups applied position by position do, with
+# as many applications.
+def test_batch_attachment():
+	font = attach_font()
+	rnd = random.Random(3)
+	alphabet = 'AABBCDFGHLMMNNOOPPX'
+	for i in range(20):
+		tokens = [rnd.choice(alphabet) for j in range(rnd.randint(200, 400))]
+		batch = font.apply(tokens, trace=TRACE_OFF, clusters=True)
+		single = font.apply(tokens, trace=TRACE_FULL, clusters=True)
+		assert batch[0] == single[0]
+		assert batch[1] == single[1]
+		assert batch[3] == single[3]
+		assert font.apply(tokens, trace=TRACE_COUNTS)[2] == count_applications(single[2])
+	assert all(lookup.batch_source is not None for lookup in font.GPOS_lookup_list)
+	assert any(positioning != {} for positioning in batch[1])
+
+# The batch paths of the GSUB lookups give the glyphs and clusters that
+# the lookups applied position by position give, also for multiple
+# substitutions of glyphs that multiple substitutions made.
+def test_batch_substitution():
+	font = attach_font()
+	locl = Feature('locl')
+	mult = font.new_GSUB_lookup('2', feat=locl)
+	mult.add(MultSubstitution('M', ['M','P','P']))
+	mult.add(MultSubstitution('X', []))
+	mult.add(SingleSubstitution1('A', 'C'))
+	font.add_GSUB_feature(locl)
+	rnd = random.Random(4)
+	alphabet = 'AABFFGHMNX'
+	for i in range(20):
+		tokens = [rnd.choice(alphabet) for j in range(rnd.randint(200, 400))]
+		batch = font.apply(tokens, trace=TRACE_OFF, clusters=True)
+		single = font.apply(tokens, trace=TRACE_FULL, clusters=True)
+		assert batch[0] == single[0]
+		assert batch[1] == single[1]
+		assert batch[3] == single[3]
+		assert font.apply(tokens, trace=TRACE_COUNTS)[2] == count_applications(single[2])
+	assert all(lookup.batch_size is not None for lookup in font.GSUB_lookup_list)
+	assert len(set(batch[3])) < min(len(batch[3]), len(tokens))
+
 if __name__ == '__main__':
 	if not os.path.exists(gen_dir):
 		os.makedirs(gen_dir)